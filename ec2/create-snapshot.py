@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 
+import os
 import sys
-import boto.ec2
-from boto.utils import get_instance_metadata
+import errno
+import contextlib
+import threading
+import ec2common
 import logging
 import argparse
 import time
 import datetime
 import subprocess
+import Queue
+from boto.exception import EC2ResponseError
+from boto.utils import parse_ts
 
 if sys.version_info < (2, 6):
     if __name__ == "__main__":
@@ -15,16 +21,30 @@ if sys.version_info < (2, 6):
     else:
         raise Exception("we need python >= 2.6")
 
+# Tag shared by snapshots of several volumes made at once, as setupvolume.py
+# looks for to restore all of them
+SNAPSHOT_SET_TAG = "snapshot-set"
 
-def get_volume(conn, device):
-    '''Returns volume to make snapshot'''
-    instance_id = get_instance_metadata()["instance-id"]
+
+def get_volumes(conn, devices=None):
+    '''Returns volumes attached as the devices, in the same order,
+    or all volumes attached to the instance, with one API call'''
+    instance_id = ec2common.instance_id()
     logging.debug("Our instanceID is %s" % instance_id)
-    volumes = conn.get_all_volumes(filters={
-                                   'attachment.instance-id': instance_id,
-                                   'attachment.device': device})
-    logging.debug("Our volume is %s" % volumes[0])
-    return volumes[0]
+    filters = {'attachment.instance-id': instance_id}
+    if devices:
+        filters['attachment.device'] = devices
+    volumes = conn.get_all_volumes(filters=filters)
+    if devices:
+        by_device = dict((volume.attach_data.device, volume) for volume in volumes)
+        missing = [device for device in devices if device not in by_device]
+        if missing:
+            raise Exception("No volumes attached as %s" % ", ".join(missing))
+        volumes = [by_device[device] for device in devices]
+    if not volumes:
+        raise Exception("No volumes attached to %s" % instance_id)
+    logging.debug("Our volumes are %s" % volumes)
+    return volumes
 
 
 def stop_service(name):
@@ -42,11 +62,125 @@ def start_service(name):
     subprocess.check_call(["/sbin/start", name])
 
 
-def create_snapshot(conn, volume, snapshot_tags, snapshot_description=None):
-    '''Create snapshot object with the description and tags.'''
+def mount_point(device):
+    '''Returns where the device is mounted, None if it isn't'''
+    devices = set([os.path.realpath(device)])
+    # Kernel may name /dev/sdX attached volume /dev/xvdX
+    if device.startswith("/dev/sd"):
+        devices.add(os.path.realpath(device.replace("/dev/sd", "/dev/xvd", 1)))
+    with open("/proc/mounts") as mounts:
+        for line in mounts:
+            source, target = line.split()[:2]
+            if os.path.realpath(source) in devices:
+                return target.replace("\\040", " ")
+    return None
+
+
+def run_hook(command):
+    '''Runs shell command, e.g. to flush or lock db around the freeze'''
+    logging.debug("Running hook: %s" % command)
+    subprocess.check_call(command, shell=True)
+
+
+def fsfreeze(mount_dir, action):
+    '''Freezes, with -f action, or thaws, with -u, the filesystem.
+    xfs_freeze is used on systems without fsfreeze'''
+    for command in ("fsfreeze", "xfs_freeze"):
+        try:
+            subprocess.check_call([command, action, mount_dir])
+            return
+        except OSError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+    raise Exception("Neither fsfreeze nor xfs_freeze is found")
+
+
+@contextlib.contextmanager
+def frozen(mount_dirs, pre_hook=None, post_hook=None, timeout=30):
+    '''Keeps the filesystems frozen while in the block, between the hooks.
+    If the block takes longer than timeout seconds, the filesystems are thawed
+    anyway, so writes are never blocked for long'''
+    if pre_hook:
+        run_hook(pre_hook)
+    try:
+        # Most of dirty data is flushed before the freeze, so it's quick
+        subprocess.check_call(["/bin/sync"])
+        lock = threading.Lock()
+        # Filesystems frozen and not thawed yet
+        frozen_dirs = []
+
+        def thaw(reason):
+            # Every filesystem is tried, one failing to thaw must not keep
+            # the others frozen. The failed ones are tried again next time.
+            with lock:
+                thawed_dirs = []
+                for mount_dir in reversed(frozen_dirs):
+                    try:
+                        fsfreeze(mount_dir, "-u")
+                    except Exception:
+                        logging.exception("Failure thawing %s %s" % (mount_dir, reason))
+                    else:
+                        thawed_dirs.append(mount_dir)
+                for mount_dir in thawed_dirs:
+                    frozen_dirs.remove(mount_dir)
+                if thawed_dirs:
+                    logging.info("%s was frozen for %.3f seconds, thawed %s" %
+                                 (", ".join(reversed(thawed_dirs)), time.time() - started, reason))
+                if frozen_dirs:
+                    logging.critical("%s is still frozen, writes to it are blocked" % ", ".join(frozen_dirs))
+
+        started = time.time()
+        try:
+            for mount_dir in mount_dirs:
+                fsfreeze(mount_dir, "-f")
+                frozen_dirs.append(mount_dir)
+                logging.debug("Froze %s" % mount_dir)
+        except:
+            thaw("after failure to freeze")
+            raise
+        timer = threading.Timer(timeout, thaw, args=("on timeout, snapshot may be inconsistent",))
+        timer.daemon = True
+        timer.start()
+        try:
+            yield
+        finally:
+            timer.cancel()
+            thaw("once done")
+    finally:
+        if post_hook:
+            run_hook(post_hook)
+
+
+def start_snapshot(volume, snapshot_description=None, started=None):
+    '''Create snapshot object with the description, returns once it is pending.
+    The snapshot is also appended to started list, if given'''
     snapshot = volume.create_snapshot(snapshot_description)
     logging.debug("Created snapshot: %s" % snapshot)
-    # Add tags to the snapshot
+    if started is not None:
+        started.append(snapshot)
+    return snapshot
+
+
+def create_snapshots(volumes, snapshot_description=None, started=None):
+    '''Starts snapshots of all volumes at once, so they are taken at the
+    same moment. Returns the snapshots in the order of the volumes.
+    Every snapshot is also appended to started list once pending, so the
+    ones made before a failure of another can still be tagged'''
+    return ec2common.run_parallel(start_snapshot, [(volume, snapshot_description, started)
+                                                   for volume in volumes])
+
+
+def tag_snapshots(snapshots, snapshot_tags):
+    '''Tags the snapshots, several of them as a set with shared id'''
+    if len(snapshots) > 1:
+        snapshot_set = "%s-%s" % (ec2common.instance_id(),
+                                  datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"))
+        snapshot_tags = dict(snapshot_tags, **{SNAPSHOT_SET_TAG: snapshot_set})
+    ec2common.run_parallel(tag_snapshot, [(snapshot, snapshot_tags) for snapshot in snapshots])
+
+
+def tag_snapshot(snapshot, snapshot_tags):
+    '''Add tags to the snapshot'''
     for tagname, tagvalue in snapshot_tags.iteritems():
         snapshot.add_tag(tagname, tagvalue)
         logging.debug("Tagged snapshot: %s with tags: %s"
@@ -60,40 +194,79 @@ def params_to_dict(tags):
     return dict(tags_name_value_list)
 
 
-def cleanup_snapshots(conn, snapshots_tags, retention):
-    '''Delete older than retention age snapshots with specified tags.'''
-    # Date for older snapshots
-    retention_date = (datetime.datetime.today() -
-                      datetime.timedelta(days=retention)
-                      ).strftime('%Y-%m-%dT%H:%M:%S')
+def cleanup_snapshots(conn, snapshots_tags, retention, workers=8, dry_run=False):
+    '''Delete older than retention age snapshots with specified tags.
+    Snapshots are listed page by page and deleted by pool of workers, all
+    slowing down together when EC2 API throttles them.
+    With dry_run only reports the snapshots that would be deleted.
+    Returns the deleted snapshots'''
+    # Date for older snapshots, start times of snapshots are in UTC
+    retention_date = datetime.datetime.utcnow() - datetime.timedelta(days=retention)
     logging.debug("Retention date: %s" % retention_date)
     # Form filter dictionary
     filter_dict = {}
     for key, val in snapshots_tags.iteritems():
         filter_dict["tag:" + key] = val
-    snapshots = conn.get_all_snapshots(owner="self", filters=filter_dict)
-    logging.debug("Snapshots list that matches tags:" % snapshots)
-    # Delete stale snapshots
-    if snapshots:
-        stale_snapshots = [snapshot for snapshot in snapshots
-                           if snapshot.start_time < retention_date]
-        logging.debug("Stale snapshots that are older"
-                      "than retention date %s: %s"
-                      % (retention_date, stale_snapshots))
+    throttle = ec2common.Throttle()
+    stale_snapshots = (snapshot for snapshot in ec2common.iter_snapshots(conn, filter_dict, throttle=throttle)
+                       if parse_ts(snapshot.start_time) < retention_date)
+    if dry_run:
+        stale_snapshots = list(stale_snapshots)
         for snapshot in stale_snapshots:
-            snapshot.delete()
-            logging.info("Deleted snapshot: %s" % snapshot)
-    else:
-        stale_snapshots = None
+            logging.info("Would delete snapshot: %s of %s GiB started %s" %
+                         (snapshot, snapshot.volume_size, snapshot.start_time))
+        logging.info("Would delete %s snapshots of %s GiB total older than %s" %
+                     (len(stale_snapshots), sum(int(snapshot.volume_size or 0) for snapshot in stale_snapshots),
+                      retention_date))
+        return []
 
-    return stale_snapshots
+    deleted = []
+    failed = []
+    # Bounded, so listing doesn't run far ahead of deleting
+    snapshots = Queue.Queue(workers * 2)
+
+    def delete():
+        while True:
+            snapshot = snapshots.get()
+            if snapshot is None:
+                return
+            try:
+                throttle.call(snapshot.delete)
+            except EC2ResponseError, exc:
+                # Used by AMI or already deleted by another run
+                if exc.error_code in ("InvalidSnapshot.InUse", "InvalidSnapshot.NotFound"):
+                    logging.warning("Skipped snapshot %s: %s" % (snapshot, exc.error_code))
+                else:
+                    logging.error("Failure deleting snapshot %s: %s" % (snapshot, exc))
+                    failed.append(snapshot)
+            except Exception, exc:
+                logging.error("Failure deleting snapshot %s: %s" % (snapshot, exc))
+                failed.append(snapshot)
+            else:
+                logging.info("Deleted snapshot: %s" % snapshot)
+                deleted.append(snapshot)
+
+    threads = [threading.Thread(target=delete, name="delete-%s" % number) for number in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for snapshot in stale_snapshots:
+            snapshots.put(snapshot)
+    finally:
+        for thread in threads:
+            snapshots.put(None)
+        for thread in threads:
+            thread.join()
+    if failed:
+        raise Exception("Failure deleting snapshots %s" % failed)
+    return deleted
 
 
 def main():
 
     # Parse all arguments
     epilog = "EXAMPLE: %(prog)s --device /dev/xvdg --tag-value Environment:dev --tag-value Role:mysql-backup"
-    description = "Create snapshot for EBS volume with some data with optional stop of some service"
+    description = "Create snapshot for EBS volumes with some data with optional stop of some service"
     "that produced that data. Older than retention time snapshots are deleted"
 
     parser = argparse.ArgumentParser(description=description, epilog=epilog)
@@ -103,14 +276,44 @@ def main():
     parser.add_argument("--service", "-s",
                         type=str, default=None,
                         help="Service to stop before and start after the volume snapshot")
-    parser.add_argument("--device", "-d",
+    parser.add_argument("--freeze", "-f",
+                        action="store_true", default=False,
+                        help="Freeze filesystem of the device instead of stopping the service, "
+                        "thawed as soon as the snapshot is started")
+    parser.add_argument("--mount-dir", "-m",
                         type=str,
-                        required=True,
-                        help="Device of the volume snapshot")
+                        action="append", default=None,
+                        help="Filesystem to freeze, by default where the devices are mounted, "
+                        "can be repeated. Needed for striped volume")
+    parser.add_argument("--pre-freeze",
+                        type=str, default=None,
+                        help="Shell command to run before the freeze, e.g. to flush db")
+    parser.add_argument("--post-thaw",
+                        type=str, default=None,
+                        help="Shell command to run after the thaw, also when the freeze failed")
+    parser.add_argument("--freeze-timeout",
+                        type=int, default=30,
+                        help="Thaw filesystem after that many seconds even if the snapshot "
+                        "isn't started yet, by default 30")
+    devices = parser.add_mutually_exclusive_group()
+    devices.add_argument("--device", "-d",
+                         type=str, action="append",
+                         help="Device of the volume snapshot, can be repeated to snapshot "
+                         "several volumes at once and tag them as a set")
+    devices.add_argument("--all-volumes", "-a",
+                         action="store_true", default=False,
+                         help="Snapshot all volumes attached to the instance as a set")
     parser.add_argument("--retention", "-r",
                         type=int, default=30,
                         help="Delete snapshots older than specified"
                              "retention days period")
+    parser.add_argument("--workers",
+                        type=int, default=8,
+                        help="Snapshots to delete at once, by default 8")
+    parser.add_argument("--dry-run", "-n",
+                        action="store_true", default=False,
+                        help="Only report older than retention snapshots that would be deleted, "
+                        "without making new snapshot")
     parser.add_argument("--tag-value", "-t",
                         dest="tags",
                         action="append",
@@ -133,6 +336,11 @@ def main():
         parser.print_help()
         sys.exit(1)
 
+    if not (args.device or args.all_volumes or args.dry_run):
+        parser.error("one of the arguments --device --all-volumes is required")
+    if args.freeze and args.service:
+        parser.error("--freeze and --service cannot be used together")
+
     tags_dict = params_to_dict(args.tags)
 
     logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s: %(message)s',
@@ -140,27 +348,46 @@ def main():
     # Output will be like: "2013-05-12 13:00:09,934 root WARNING: some warning text"
     logging.info("====================================================")
     logging.info("Started backup of volume")
-    logging.debug("Used volume device: %s" % args.device)
+    logging.debug("Used volume devices: %s" % (args.device or "all"))
     logging.debug("Used snapshot tags: %s" % tags_dict)
     logging.debug("Used snapshot retention period: %s" % args.retention)
     logging.debug("Used snapshot description: %s" % args.snapshot_description)
 
-    # NOTE: for EC2 connection we rely on the presence of:
-    #   * ~/.boto or /etc/boto.cfg config files or
-    #   * AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environmental variables
-    #   * or IAM instance profile
+    # See ec2common.get_connection for where boto gets credentials from
     try:
-        conn = boto.ec2.connect_to_region(get_instance_metadata()
-                                          ["placement"]
-                                          ["availability-zone"][:-1])
+        conn = ec2common.get_connection()
     except:
         logging.exception("Failure getting EC2 API connection")
         sys.exit(1)
 
+    if not args.dry_run:
+        backup(conn, args, tags_dict)
+
+    # Perform cleanup of older snapshots
+    try:
+        removed_snapshots = cleanup_snapshots(conn,
+                                              tags_dict,
+                                              args.retention,
+                                              args.workers,
+                                              args.dry_run)
+    except:
+        logging.exception("Failure cleaning up snapshots")
+        sys.exit(1)
+    else:
+        if removed_snapshots:
+            logging.info("Deleted %s stale snapshots" % len(removed_snapshots))
+        else:
+            logging.info("No stale snapshots were removed")
+
+    logging.info("====================================================")
+
+
+def backup(conn, args, tags_dict):
+    '''Makes snapshots of the volumes as set by the args, exits on failure'''
     try:
-        volume = get_volume(conn, args.device)
+        volumes = get_volumes(conn, args.device)
     except:
-        logging.exception("Failure getting the volume")
+        logging.exception("Failure getting the volumes")
         sys.exit(1)
 
     # Stop service before making snapshot
@@ -172,36 +399,38 @@ def main():
         else:
             logging.info("%s stopped for backup" % args.service)
 
-    # Make snapshot, tag it and start any service
+    # Make snapshots, tag them and start any service
+    started = time.time()
+    pending = []
     try:
-        snapshot = create_snapshot(conn, volume,
-                                   tags_dict,
-                                   args.snapshot_description)
+        try:
+            if args.freeze:
+                mount_dirs = args.mount_dir
+                if not mount_dirs:
+                    mount_dirs = sorted(set(filter(None, [mount_point(volume.attach_data.device)
+                                                          for volume in volumes])))
+                if not mount_dirs:
+                    raise Exception("None of the devices is mounted")
+                # Tagged after the thaw, only starting snapshots must be frozen
+                with frozen(mount_dirs, args.pre_freeze, args.post_thaw, args.freeze_timeout):
+                    snapshots = create_snapshots(volumes, args.snapshot_description, pending)
+            else:
+                snapshots = create_snapshots(volumes, args.snapshot_description, pending)
+        finally:
+            # Also the ones made before a failure, cleanup finds snapshots
+            # only by their tags, untagged ones would be kept forever
+            if pending:
+                tag_snapshots(pending, tags_dict)
     except:
         logging.exception("Failure making snapshot")
         sys.exit(1)
     else:
-        logging.info("Created new snapshot %s" % snapshot)
-        logging.info("Tagged snapshot with tags %s" % tags_dict)
+        logging.info("Created new snapshots %s in %.1f seconds" % (snapshots, time.time() - started))
+        logging.info("Tagged snapshots with tags %s" % tags_dict)
     finally:
         if args.service:
             start_service(args.service)
 
-    # Perform cleanup of older snapshots
-    try:
-        removed_snapshots = cleanup_snapshots(conn,
-                                              tags_dict,
-                                              args.retention)
-    except:
-        logging.exception("Failure cleaning up snapshots")
-        sys.exit(1)
-    else:
-        if removed_snapshots:
-            logging.info("Deleted stale snapshots %s" % removed_snapshots)
-        else:
-            logging.info("No stale snapshots were removed")
-
-    logging.info("====================================================")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,222 @@
+# Helpers shared by the ec2 scripts.
+# Instance identity is fetched from the metadata service once per process
+# and cached on disk for a short time, so scripts run back to back from cron
+# don't wait for the metadata service again. One EC2 API connection to the
+# region of the instance is shared by the whole process, also by the threads
+# of run_parallel.
+
+import os
+import sys
+import stat
+import json
+import time
+import random
+import logging
+import tempfile
+import threading
+import boto.ec2
+from boto.ec2.snapshot import Snapshot
+from boto.exception import EC2ResponseError
+from boto.utils import get_instance_identity
+
+# Identity document cache, in a directory only root can write to. The
+# identity decides which volumes get attached and snapshotted, so a file
+# anyone else could have planted is never trusted.
+CACHE_FILE = "/var/cache/ec2-instance-identity.json"
+# Seconds the cached identity is used for
+CACHE_TTL = 300
+
+_lock = threading.Lock()
+_identity = None
+_connection = None
+
+
+def _boot_id():
+    '''Changes on every boot, so cache baked into an AMI is never used'''
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as boot_id:
+            return boot_id.read().strip()
+    except IOError:
+        return None
+
+
+def _read_cache(path, ttl):
+    try:
+        with open(path) as cache_file:
+            status = os.fstat(cache_file.fileno())
+            if status.st_uid != os.geteuid() or status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                logging.warning("Ignoring instance identity cache %s not owned by us "
+                                "or writable by others" % path)
+                return None
+            cache = json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return None
+    now = time.time()
+    fetched = cache.get("fetched", 0)
+    # Fetched in the future means a broken clock or a forged file
+    if cache.get("boot_id") != _boot_id() or not now - ttl <= fetched <= now:
+        return None
+    return cache.get("document")
+
+
+def write_json(path, data, mode=None):
+    '''Writes data to path as JSON, to temporary file renamed over path,
+    so readers and crashes never leave half of it'''
+    path = os.path.abspath(path)
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     prefix=".%s-" % os.path.basename(path))
+    try:
+        with os.fdopen(fd, "w") as json_file:
+            json.dump(data, json_file)
+        if mode is not None:
+            os.chmod(temporary, mode)
+        os.rename(temporary, path)
+    except:
+        os.unlink(temporary)
+        raise
+
+
+def _write_cache(path, document):
+    try:
+        write_json(path, {"fetched": time.time(), "boot_id": _boot_id(),
+                          "document": document}, 0644)
+    except (IOError, OSError), exc:
+        logging.debug("Cannot cache instance identity in %s: %s" % (path, exc))
+
+
+def instance_identity(cache_file=CACHE_FILE, ttl=CACHE_TTL):
+    '''Returns the instance identity document, e.g. instanceId, region,
+    availabilityZone, accountId'''
+    global _identity
+    with _lock:
+        if _identity is None:
+            _identity = ttl and _read_cache(cache_file, ttl)
+            if _identity:
+                logging.debug("Using instance identity cached in %s" % cache_file)
+            else:
+                _identity = get_instance_identity()["document"]
+                if ttl:
+                    _write_cache(cache_file, _identity)
+        return _identity
+
+
+def instance_id():
+    return instance_identity()["instanceId"]
+
+
+def availability_zone():
+    return instance_identity()["availabilityZone"]
+
+
+def region():
+    return instance_identity()["region"]
+
+
+def get_connection():
+    '''Returns EC2 API connection to the region of the instance.
+
+    NOTE: for EC2 connection we rely on the presence of:
+      * ~/.boto or /etc/boto.cfg config files or
+      * AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environmental variables
+      * or IAM instance profile
+    '''
+    global _connection
+    region_name = region()
+    with _lock:
+        if _connection is None:
+            _connection = boto.ec2.connect_to_region(region_name)
+        return _connection
+
+
+def run_parallel(function, args_list):
+    '''Calls function with every tuple of args in its own thread.
+    Returns list of results in the same order, re-raises the first failure
+    once all threads are done'''
+    results = [None] * len(args_list)
+    errors = []
+
+    def run(index, args):
+        try:
+            results[index] = function(*args)
+        except Exception, exc:
+            logging.error("Failure in %s: %s" % (function.__name__, exc))
+            errors.append(sys.exc_info())
+
+    # Named after the calling thread, so their logging is told apart
+    # when several volumes are set up at once
+    threads = [threading.Thread(target=run, args=(index, args),
+                                name="%s-%s" % (threading.current_thread().name, index))
+               for index, args in enumerate(args_list)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def backoff_delays(initial, maximum, factor=2):
+    '''Endless exponentially growing delays, jittered so many
+    instances booting at once don't poll in lockstep'''
+    delay = initial
+    while True:
+        yield random.uniform(delay / 2.0, delay)
+        delay = min(delay * factor, maximum)
+
+
+class Throttle(object):
+
+    '''Pace of EC2 API calls shared by several threads. Every call
+    throttled with RequestLimitExceeded doubles the pause before the next
+    calls, up to maximum seconds, and is retried. Every successful call
+    halves the pause, down to none.
+
+    '''
+
+    def __init__(self, initial=0.5, maximum=30, retries=10):
+        self.initial = initial
+        self.maximum = maximum
+        self.retries = retries
+        self.delay = 0
+        self._lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            with self._lock:
+                delay = self.delay
+            if delay:
+                time.sleep(random.uniform(delay / 2.0, delay))
+            try:
+                result = function(*args, **kwargs)
+            except EC2ResponseError, exc:
+                if exc.error_code != "RequestLimitExceeded" or attempt >= self.retries:
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.delay = min(max(self.delay * 2, self.initial), self.maximum)
+                logging.debug("EC2 API throttled us, pausing calls for up to %.1f seconds" % self.delay)
+            else:
+                with self._lock:
+                    self.delay = self.delay >= self.initial * 2 and self.delay / 2 or 0
+                return result
+
+
+def iter_snapshots(conn, filters, owner="self", page_size=1000, throttle=None):
+    '''Yields own snapshots matching the filters page by page,
+    so the whole list is never held in memory'''
+    # boto's get_all_snapshots doesn't page, same request with MaxResults
+    params = {"MaxResults": page_size}
+    conn.build_list_params(params, [owner], "Owner")
+    conn.build_filter_params(params, filters)
+    while True:
+        if throttle:
+            page = throttle.call(conn.get_list, "DescribeSnapshots", params, [("item", Snapshot)], verb="POST")
+        else:
+            page = conn.get_list("DescribeSnapshots", params, [("item", Snapshot)], verb="POST")
+        for snapshot in page:
+            yield snapshot
+        if not page.next_token:
+            return
+        params["NextToken"] = page.next_token
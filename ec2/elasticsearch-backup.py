@@ -6,7 +6,7 @@ import json
 import logging
 import argparse
 import datetime
-from boto.utils import get_instance_identity
+import ec2common
 from lockfile import FileLock
 
 if sys.version_info < (2, 6):
@@ -61,8 +61,7 @@ def create_repository(args):
                                       args.repository])
     # Get the region from the instance
     try:
-        instance_metadata = get_instance_identity()
-        instance_region = instance_metadata['document']['region']
+        instance_region = ec2common.region()
     except:
         logging.exception("Failure getting EC2 instance data")
         raise
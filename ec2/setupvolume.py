@@ -2,13 +2,29 @@
 
 import os
 import sys
+import stat
 import errno
-import boto.ec2
-from boto.utils import get_instance_metadata
+import ctypes
+import ctypes.util
+import mmap
+import struct
+import random
+import select
+import json
+import datetime
+from boto.exception import EC2ResponseError
+import ec2common
+from ec2common import run_parallel, backoff_delays, iter_snapshots, write_json
 import logging
 import argparse
 import time
 import subprocess
+import threading
+try:
+    import yaml
+except ImportError:
+    # Spec files can be JSON only then
+    yaml = None
 
 if sys.version_info < (2, 6):
     if __name__ == "__main__":
@@ -17,18 +33,706 @@ if sys.version_info < (2, 6):
         raise Exception("we need python >= 2.6")
 
 
+# inotify(7) events telling a device node may have appeared
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+def is_block_device(device):
+    '''True if the path, or what it links to, is a block device'''
+    try:
+        return stat.S_ISBLK(os.stat(device).st_mode)
+    except OSError:
+        return False
+
+
+def device_names(device, count):
+    '''Consecutive device names, /dev/sdh and 3 gives /dev/sdh, /dev/sdi, /dev/sdj'''
+    if count > 1 and not "a" <= device[-1] <= "z":
+        raise Exception("Cannot derive more device names from", device)
+    if ord(device[-1]) + count - 1 > ord("z"):
+        raise Exception("Not enough device names after", device)
+    return [device[:-1] + chr(ord(device[-1]) + number) for number in range(count)]
+
+
+class DeviceWatcher(object):
+
+    '''Waits for a device node to appear.
+    Watches the directory of the node with inotify, so we wake up as soon as
+    udev creates it, and falls back to polling if inotify is not available.
+
+    '''
+    def __init__(self, device, check=is_block_device):
+        self.device = device
+        self.check = check
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init()
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init failed")
+            if libc.inotify_add_watch(fd, os.path.dirname(device) or ".",
+                                      IN_CREATE | IN_MOVED_TO | IN_ATTRIB) < 0:
+                error = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(error, "inotify_add_watch failed")
+            self.fd = fd
+        except (OSError, AttributeError), exc:
+            logging.debug("No inotify for %s, will poll for it: %s" % (device, exc))
+
+    def wait(self, timeout):
+        '''Returns True once the device is present, False on timeout'''
+        deadline = time.time() + timeout
+        delays = backoff_delays(0.1, 2)
+        try:
+            # The watch is set up before the first check, so an event
+            # between the check and select() is not missed.
+            while not self.check(self.device):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                if self.fd is None:
+                    time.sleep(min(next(delays), remaining))
+                elif select.select([self.fd], [], [], remaining)[0]:
+                    # Events themselves don't matter, just drain them
+                    os.read(self.fd, 4096)
+            return True
+        finally:
+            self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def newest_snapshot(snapshots):
+    '''The last started of the snapshots, looked through once without sorting'''
+    newest = None
+    for snapshot in snapshots:
+        # ISO 8601 times in UTC compare as strings
+        if newest is None or snapshot.start_time > newest.start_time:
+            newest = snapshot
+    return newest
+
+
+class SnapshotIndex(object):
+
+    '''Local index of the newest snapshot matching some filters.
+    Later lookups only list snapshots started since the previous one,
+    with day wildcards on start-time filter, and check the indexed
+    snapshot still exists. One index can be shared by threads.
+
+    '''
+    # Days back from the previous lookup to list again, for snapshots
+    # that were still pending then
+    OVERLAP_DAYS = 2
+    # Do a full lookup if the previous one is older than this
+    MAX_DAYS = 30
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as index_file:
+                self.entries = json.load(index_file)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        write_json(self.path, self.entries)
+
+    def newest(self, conn, filters):
+        '''Returns the newest snapshot matching the filters'''
+        key = json.dumps(filters, sort_keys=True)
+        with self._lock:
+            entry = self.entries.get(key)
+        now = datetime.datetime.utcnow()
+        newest = None
+        if entry:
+            checked = datetime.datetime.strptime(entry["checked"], "%Y-%m-%d")
+            if (now - checked).days <= self.MAX_DAYS:
+                newest = self._incremental(conn, filters, entry, checked, now)
+        if newest is None:
+            logging.debug("Looking through all snapshots matching %s" % filters)
+            newest = newest_snapshot(iter_snapshots(conn, filters))
+        if newest:
+            # Snapshots are listed unlocked, only the file is written in turns
+            with self._lock:
+                self.entries[key] = {"snapshot_id": newest.id, "checked": now.strftime("%Y-%m-%d")}
+                self.save()
+        return newest
+
+    def _incremental(self, conn, filters, entry, checked, now):
+        try:
+            indexed = conn.get_all_snapshots(snapshot_ids=[entry["snapshot_id"]], filters=filters)
+        except EC2ResponseError, exc:
+            logging.debug("Indexed snapshot %s is gone: %s" % (entry["snapshot_id"], exc.error_code))
+            return None
+        if not indexed:
+            return None
+        day = checked - datetime.timedelta(days=self.OVERLAP_DAYS)
+        days = []
+        while day <= now:
+            days.append(day.strftime("%Y-%m-%d*"))
+            day += datetime.timedelta(days=1)
+        logging.debug("Looking through snapshots started on %s" % ", ".join(days))
+        try:
+            return newest_snapshot([indexed[0]] + list(iter_snapshots(conn, dict(filters, **{"start-time": days}))))
+        except EC2ResponseError, exc:
+            logging.warning("Failure listing snapshots by start time, doing full lookup: %s" % exc)
+            return None
+
+
+class SetupJournal(object):
+
+    '''Local record of the completed steps of one volume setup, keyed by
+    device and mount dir, so a rerun after failure resumes from the last
+    completed step with the volume already created.
+    Without directory the journal is only kept in memory.
+
+    '''
+
+    def __init__(self, directory, device, mount_dir, instance_id):
+        self.path = directory and os.path.join(directory, "%s.json" % "".join(
+            character if character.isalnum() else "_" for character in device + mount_dir))
+        self.instance_id = instance_id
+        self.entry = {}
+        if self.path:
+            try:
+                with open(self.path) as journal_file:
+                    self.entry = json.load(journal_file)
+            except (IOError, ValueError):
+                pass
+        # Journal could be baked into AMI or left by volume of another instance
+        if self.entry.get("instance_id") != instance_id:
+            self.entry = {}
+
+    def get(self, name):
+        return self.entry.get(name)
+
+    def done(self, step):
+        return step in self.entry.get("steps", [])
+
+    def record(self, step, **values):
+        '''Marks the step done, storing values along with it'''
+        self.entry.setdefault("steps", []).append(step)
+        self.entry.update(values, instance_id=self.instance_id, updated=time.time())
+        logging.debug("Step %s done" % step)
+        self.save()
+
+    def reset(self):
+        self.entry = {}
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        # Volumes of a spec are set up in parallel, all into one new directory
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError, exc:
+            if exc.errno == errno.EEXIST and os.path.isdir(os.path.dirname(self.path)):
+                pass
+            else:
+                raise
+        write_json(self.path, self.entry)
+
+
+def open_direct(path, write=False, direct=True):
+    '''Opens path for unbuffered reading, or writing too, bypassing page cache
+    if possible. Returns file object for readinto() and write() with buffer
+    from aligned_buffer()'''
+    if write:
+        flags, mode = os.O_RDWR | os.O_CREAT, "r+b"
+    else:
+        flags, mode = os.O_RDONLY, "rb"
+    try:
+        fd = os.open(path, flags | (direct and getattr(os, "O_DIRECT", 0)), 0600)
+    except OSError, exc:
+        if exc.errno != errno.EINVAL:
+            raise
+        # Some filesystems, like tmpfs, don't support O_DIRECT
+        fd = os.open(path, flags, 0600)
+    return os.fdopen(fd, mode, 0)
+
+
+def aligned_buffer(size):
+    '''Page aligned buffer, as O_DIRECT reads need'''
+    return mmap.mmap(-1, size)
+
+
+def mkfs_options(format_fs, profile="fast", volume_type=None, size=None,
+                 stripe_unit=None, stripes=None):
+    '''Options for mkfs of the FS, on volume of the type and size in GiB.
+    The fast profile skips what EBS doesn't need: discard of a volume that
+    is new anyway and eager initialization of ext inode tables and journal.
+    The plain profile formats as mkfs does by default.
+    Both align to stripes, stripe_unit in KiB, if the volume is striped'''
+    options = []
+    if "ext" in format_fs:
+        options = ['-q', '-F']
+        extended = []
+        if profile == "fast":
+            extended = ['lazy_itable_init=1', 'nodiscard']
+            if format_fs != "ext2":
+                extended.append('lazy_journal_init=1')
+            # Throughput optimized HDD volumes keep few big files,
+            # fewer inodes to make and to check
+            if volume_type in ("st1", "sc1"):
+                options += ['-T', 'largefile']
+        if stripe_unit and stripes:
+            # In FS blocks of 4KiB
+            stride = stripe_unit / 4
+            extended += ['stride=%s' % stride, 'stripe_width=%s' % (stride * stripes)]
+        if extended:
+            options += ['-E', ",".join(extended)]
+    elif format_fs == "xfs":
+        options = ['-q', '-f']
+        log = []
+        if profile == "fast":
+            options.append('-K')
+            # Bigger log for bigger volumes, small default log
+            # throttles metadata heavy workloads
+            if size and size >= 1024:
+                log.append('size=1024m')
+            elif size and size >= 100:
+                log.append('size=256m')
+        if stripe_unit and stripes:
+            options += ['-d', 'su=%sk,sw=%s' % (stripe_unit, stripes)]
+            # Log stripe unit can't be over 256KiB
+            log.append('su=%sk' % min(stripe_unit, 256))
+        if log:
+            options += ['-l', ",".join(log)]
+    elif format_fs == "btrfs":
+        options = ['-q', '-f']
+        if profile == "fast":
+            options.append('-K')
+    return options
+
+
+def format_bytes(count):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if count < 1024:
+            return "%.1f%s" % (count, unit)
+        count /= 1024.0
+    return "%.1fTiB" % count
+
+
+class Prewarmer(object):
+
+    '''Reads every block of the device, so volume restored from snapshot gets
+    all of its data loaded from S3 now instead of on first use.
+    Threads read consecutive blocks with direct I/O, so the page cache
+    isn't flooded. Hot files can be read first, so they are fast soonest.
+
+    '''
+    def __init__(self, device, threads=16, block_size=1024 * 1024, report_interval=30):
+        self.device = device
+        self.threads = threads
+        self.block_size = block_size
+        self.report_interval = report_interval
+        self._lock = threading.Lock()
+        self._next_offset = 0
+        self._done = 0
+
+    def device_size(self):
+        with open(self.device, "rb") as device:
+            device.seek(0, os.SEEK_END)
+            return device.tell()
+
+    def _claim(self, size):
+        with self._lock:
+            offset = self._next_offset
+            if offset >= size:
+                return None
+            self._next_offset += self.block_size
+            return offset
+
+    def _read_device(self, size):
+        device = open_direct(self.device)
+        buf = aligned_buffer(self.block_size)
+        try:
+            while True:
+                offset = self._claim(size)
+                if offset is None:
+                    return
+                device.seek(offset)
+                read = device.readinto(buf)
+                with self._lock:
+                    self._done += read
+        finally:
+            device.close()
+
+    def _read_files(self, files):
+        buf = aligned_buffer(self.block_size)
+        while True:
+            with self._lock:
+                if not files:
+                    return
+                path = files.pop()
+            try:
+                hot_file = open_direct(path)
+            except (IOError, OSError), exc:
+                logging.debug("Cannot pre-warm %s: %s" % (path, exc))
+                continue
+            try:
+                while True:
+                    read = hot_file.readinto(buf)
+                    if not read:
+                        break
+                    with self._lock:
+                        self._done += read
+            finally:
+                hot_file.close()
+
+    def _report(self, stage, total, finished):
+        started = time.time()
+        while not finished.wait(self.report_interval):
+            with self._lock:
+                done = self._done
+            elapsed = time.time() - started
+            rate = done / elapsed
+            if rate and total:
+                eta = "%.0f seconds" % ((total - done) / rate)
+            else:
+                eta = "unknown"
+            logging.info("Pre-warming %s: %s of %s (%.1f%%) at %s/s, ETA %s" %
+                         (stage, format_bytes(done), format_bytes(total),
+                          100.0 * done / max(total, 1), format_bytes(rate), eta))
+
+    def _run(self, stage, target, args, total):
+        self._done = 0
+        started = time.time()
+        finished = threading.Event()
+        reporter = threading.Thread(target=self._report, args=(stage, total, finished))
+        reporter.daemon = True
+        reporter.start()
+        try:
+            run_parallel(target, [args] * self.threads)
+        finally:
+            finished.set()
+        elapsed = time.time() - started
+        logging.info("Pre-warmed %s: %s in %.0f seconds, %s/s" %
+                     (stage, format_bytes(self._done), elapsed,
+                      format_bytes(self._done / max(elapsed, 0.001))))
+
+    def warm_files(self, paths):
+        '''Reads all files under the paths, largest first'''
+        files = []
+        for path in paths:
+            if os.path.isfile(path):
+                files.append(path)
+            for root, dirs, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        sizes = dict((path, os.path.getsize(path)) for path in files if os.path.isfile(path))
+        # Popped from the end, so the largest go first
+        files = sorted(sizes, key=sizes.get)
+        self._run("hot files", self._read_files, (files,), sum(sizes.values()))
+
+    def warm_device(self):
+        '''Reads the whole device'''
+        size = self.device_size()
+        self._next_offset = 0
+        self._run(self.device, self._read_device, (size,), size)
+
+
+def device_sectors(device):
+    '''Size of the block device in 512 byte sectors'''
+    return int(subprocess.check_output(["blockdev", "--getsz", device]))
+
+
+def cache_stats(name):
+    '''Returns usage and hit rates of the dm-cache device, None if there is none'''
+    try:
+        with open(os.devnull, "w") as devnull:
+            status = subprocess.check_output(["dmsetup", "status", name], stderr=devnull).split()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if len(status) < 14 or status[2] != "cache":
+        return None
+    # <start> <length> cache <metadata block size> <used>/<total metadata blocks>
+    # <cache block size> <used>/<total cache blocks> <read hits> <read misses>
+    # <write hits> <write misses> <demotions> <promotions> <dirty> ...
+    used, total = [int(count) for count in status[6].split("/")]
+    read_hits, read_misses, write_hits, write_misses, demotions, promotions, dirty = \
+        [int(count) for count in status[7:14]]
+    return {"block_size": int(status[5]) * 512,
+            "used_blocks": used,
+            "total_blocks": total,
+            "read_hits": read_hits,
+            "read_misses": read_misses,
+            "read_hit_rate": round(float(read_hits) / (read_hits + read_misses or 1), 4),
+            "write_hits": write_hits,
+            "write_misses": write_misses,
+            "write_hit_rate": round(float(write_hits) / (write_hits + write_misses or 1), 4),
+            "demotions": demotions,
+            "promotions": promotions,
+            "dirty_blocks": dirty}
+
+
+class DmCache(object):
+
+    '''dm-cache device of the origin, the EBS volume, cached on a fast local
+    device, the NVMe instance store. The start of the cache device keeps
+    the cache metadata, up to size bytes of the rest the cached blocks.
+    The origin keeps plain filesystem, so its snapshots can be used without
+    the cache, as long as the cache is writethrough or clean.
+    Works with any block devices, e.g. loop devices.
+
+    '''
+    MODES = ("writethrough", "writeback", "passthrough")
+    # Magic number of the metadata superblock, at offset 32 of its first block
+    SUPERBLOCK_MAGIC = 06142003
+
+    def __init__(self, name, origin, cache_device, size=None, mode="writethrough",
+                 policy="smq", block_size=256 * 1024):
+        if mode not in self.MODES:
+            raise ValueError("Unknown cache mode %s" % mode)
+        if block_size % (32 * 1024) or not 32 * 1024 <= block_size <= 1024 ** 3:
+            raise ValueError("Cache block size must be multiple of 32KiB up to 1GiB")
+        self.name = name
+        self.origin = origin
+        self.cache_device = cache_device
+        self.size = size
+        self.mode = mode
+        self.policy = policy
+        self.block_size = block_size
+        self.device = "/dev/mapper/%s" % name
+
+    def _dmsetup_create(self, name, table):
+        logging.debug("Creating %s with table: %s" % (name, table))
+        subprocess.check_call(["dmsetup", "create", name, "--table", table])
+
+    def has_metadata(self):
+        '''Returns True if the cache device starts with dm-cache metadata'''
+        with open(self.cache_device, "rb") as cache_device:
+            superblock = cache_device.read(40)
+        return len(superblock) == 40 and struct.unpack("<Q", superblock[32:])[0] == self.SUPERBLOCK_MAGIC
+
+    def create(self, fresh=True):
+        '''Creates the device, returns its path. Unless fresh, metadata left on
+        the cache device is kept, e.g. with dirty blocks after reboot. With
+        fresh None it is kept if the cache device has any, only safe when the
+        origin is known to be the volume the metadata was made for'''
+        if fresh is None:
+            fresh = not self.has_metadata()
+            if fresh:
+                logging.warning("No cache metadata on %s, starting with empty cache" % self.cache_device)
+            else:
+                logging.info("Keeping cache metadata found on %s" % self.cache_device)
+        block_sectors = self.block_size / 512
+        cache_sectors = device_sectors(self.cache_device)
+        # Metadata takes 4MiB and 16 bytes per cache block, doubled for safety
+        metadata_sectors = (2 * (4 * 1024 * 1024 + 16 * cache_sectors / block_sectors)) / 512
+        metadata_sectors += -metadata_sectors % 2048
+        blocks_sectors = cache_sectors - metadata_sectors
+        if self.size:
+            blocks_sectors = min(blocks_sectors, self.size / 512)
+        blocks_sectors -= blocks_sectors % block_sectors
+        if blocks_sectors <= 0:
+            raise Exception("Cache device is too small", self.cache_device)
+        metadata = "%s-metadata" % self.name
+        blocks = "%s-blocks" % self.name
+        try:
+            self._dmsetup_create(metadata, "0 %s linear %s 0" % (metadata_sectors, self.cache_device))
+            if fresh:
+                # Zeroed superblock makes dm-cache format the metadata
+                subprocess.check_call(["dd", "if=/dev/zero", "of=/dev/mapper/%s" % metadata,
+                                       "bs=4096", "count=1", "oflag=direct"])
+            self._dmsetup_create(blocks, "0 %s linear %s %s" % (blocks_sectors, self.cache_device,
+                                                                 metadata_sectors))
+            self._dmsetup_create(self.name, "0 %s cache /dev/mapper/%s /dev/mapper/%s %s %s 1 %s %s 0" %
+                                 (device_sectors(self.origin), metadata, blocks, self.origin,
+                                  block_sectors, self.mode, self.policy))
+        except (OSError, subprocess.CalledProcessError):
+            logging.critical("Failure creating cache device %s" % self.name)
+            raise
+        logging.info("Cached %s on %s of %s in %s mode with %s policy as %s" %
+                     (self.origin, format_bytes(blocks_sectors * 512), self.cache_device,
+                      self.mode, self.policy, self.device))
+        return self.device
+
+    def stats(self):
+        return cache_stats(self.name)
+
+
+def percentile(values, percent):
+    '''Percentile of sorted values'''
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+class VolumeBenchmark(object):
+
+    '''Measures IOPS, throughput and latency of the mounted volume with
+    sequential and random reads and writes of a test file in the mount dir,
+    and random reads of the device itself, which are slow while a volume
+    restored from snapshot is still loading from S3.
+    Python has no asynchronous I/O, so queue depth is made with threads:
+    threads * queue_depth I/Os are in flight at once.
+
+    '''
+    # (name, random, write, block size)
+    WORKLOADS = [("seq_write", False, True, 1024 * 1024),
+                 ("seq_read", False, False, 1024 * 1024),
+                 ("rand_read", True, False, 4096),
+                 ("rand_write", True, True, 4096)]
+
+    def __init__(self, mount_dir, device=None, threads=4, queue_depth=4,
+                 file_size=1024 * 1024 * 1024, runtime=10, direct=True):
+        self.mount_dir = mount_dir
+        self.device = device
+        self.threads = threads
+        self.queue_depth = queue_depth
+        self.file_size = file_size
+        self.runtime = runtime
+        self.direct = direct
+        self.path = os.path.join(mount_dir, ".setupvolume-benchmark")
+        self._lock = threading.Lock()
+
+    def _worker(self, path, size, random_io, write, block_size, deadline, latencies):
+        target = open_direct(path, write, self.direct)
+        buf = aligned_buffer(block_size)
+        if write:
+            buf.write(os.urandom(block_size))
+        blocks = size / block_size
+        done = []
+        try:
+            while time.time() < deadline:
+                if random_io:
+                    offset = random.randrange(blocks) * block_size
+                else:
+                    with self._lock:
+                        offset = self._next_offset
+                        if offset >= size and not write:
+                            offset = self._next_offset = 0
+                        elif offset >= size:
+                            break
+                        self._next_offset += block_size
+                started = time.time()
+                target.seek(offset)
+                if write:
+                    target.write(buf)
+                else:
+                    target.readinto(buf)
+                done.append(time.time() - started)
+        finally:
+            target.close()
+        with self._lock:
+            latencies.extend(done)
+
+    def _run(self, path, size, random_io, write, block_size, runtime):
+        self._next_offset = 0
+        latencies = []
+        started = time.time()
+        run_parallel(self._worker, [(path, size, random_io, write, block_size,
+                                     started + runtime, latencies)] * (self.threads * self.queue_depth))
+        elapsed = time.time() - started
+        latencies.sort()
+        return {"block_size": block_size,
+                "seconds": round(elapsed, 3),
+                "iops": round(len(latencies) / elapsed, 1),
+                "mb_per_s": round(len(latencies) * block_size / elapsed / 1024 / 1024, 2),
+                "latency_ms": dict((name, round(value * 1000, 3)) for name, value in
+                                   (("p50", percentile(latencies, 50)),
+                                    ("p95", percentile(latencies, 95)),
+                                    ("p99", percentile(latencies, 99)),
+                                    ("max", latencies and latencies[-1] or 0)))}
+
+    def run(self):
+        '''Runs all workloads, returns the report'''
+        report = {"mount_dir": self.mount_dir,
+                  "device": self.device,
+                  "threads": self.threads,
+                  "queue_depth": self.queue_depth,
+                  "direct": self.direct,
+                  "file_size": self.file_size,
+                  "workloads": {}}
+        try:
+            for name, random_io, write, block_size in self.WORKLOADS:
+                # Sequential write lays the whole test file out, however long it takes
+                runtime = name == "seq_write" and 24 * 3600 or self.runtime
+                result = self._run(self.path, self.file_size, random_io, write, block_size, runtime)
+                report["workloads"][name] = result
+                logging.info("Benchmark %s: %s IOPS, %s MB/s, p99 latency %s ms" %
+                             (name, result["iops"], result["mb_per_s"], result["latency_ms"]["p99"]))
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        if self.device:
+            with open(self.device, "rb") as device:
+                device.seek(0, os.SEEK_END)
+                device_size = device.tell()
+            result = self._run(self.device, device_size, True, False, 4096, self.runtime)
+            report["workloads"]["device_rand_read"] = result
+            logging.info("Benchmark device_rand_read: %s IOPS, p99 latency %s ms" %
+                         (result["iops"], result["latency_ms"]["p99"]))
+        return report
+
+
+def run_benchmark(args, device=None):
+    '''Benchmarks the mounted volume as set by the args, writes the report.
+    Returns False if the volume is slower than required'''
+    report = VolumeBenchmark(args.mount_dir, device,
+                             threads=args.benchmark_threads,
+                             queue_depth=args.benchmark_queue_depth,
+                             file_size=args.benchmark_size * 1024 * 1024,
+                             runtime=args.benchmark_runtime,
+                             direct=args.direct_io).run()
+    if args.cache_device:
+        report["cache"] = cache_stats(args.cache_name)
+    passed = True
+    random_iops = min(report["workloads"]["rand_read"]["iops"],
+                      report["workloads"]["rand_write"]["iops"])
+    sequential_mbps = min(report["workloads"]["seq_read"]["mb_per_s"],
+                          report["workloads"]["seq_write"]["mb_per_s"])
+    if args.provisioned_iops:
+        logging.info("Random I/O got %.0f%% of provisioned %s IOPS" %
+                     (100.0 * random_iops / args.provisioned_iops, args.provisioned_iops))
+    if args.benchmark_min_iops and random_iops < args.benchmark_min_iops:
+        logging.error("Random I/O got %s IOPS, less than required %s" % (random_iops, args.benchmark_min_iops))
+        passed = False
+    if args.benchmark_min_mbps and sequential_mbps < args.benchmark_min_mbps:
+        logging.error("Sequential I/O got %s MB/s, less than required %s" %
+                      (sequential_mbps, args.benchmark_min_mbps))
+        passed = False
+    report["passed"] = passed
+    if args.benchmark_report == "-":
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.benchmark_report, "w") as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+    return passed
+
+
 class CreateAndMountEBSVolume(object):
 
     '''Create and mount ebs volume on EC2 instance, either from snapshot or completely new.
     In later case - format it to needed FS.
+    Several volumes can be striped together with mdadm RAID0 or LVM.
 
     '''
-    def __init__(self, conn):
+    # Tag shared by snapshots of the volumes of one striped set
+    SNAPSHOT_SET_TAG = "snapshot-set"
+    # Name of the striped logical volume in LVM mode
+    LOGICAL_VOLUME = "striped"
+
+    def __init__(self, conn, wait_timeout=900, snapshot_index=None):
         self.conn = conn
-        self.availability_zone = get_instance_metadata()["placement"]["availability-zone"]
-        self.instance_id = get_instance_metadata()["instance-id"]
-        # 3 seconds sleep period for repeatable tasks
-        self.TIME_SLEEP = 3
+        # SnapshotIndex of the given file, shared by the volumes set up in
+        # parallel, None to always look through all snapshots
+        self.snapshot_index = snapshot_index and SnapshotIndex(snapshot_index)
+        self.availability_zone = ec2common.availability_zone()
+        self.instance_id = ec2common.instance_id()
+        # Backoff bounds in seconds for polling EC2 API state
+        self.API_DELAY = 1
+        self.API_MAX_DELAY = 15
+        # Give up waiting for volume or device after this many seconds
+        self.wait_timeout = wait_timeout
         logging.debug("Our instanceID is %s in %s availability zone" %
                       (self.instance_id, self.availability_zone))
 
@@ -70,26 +774,69 @@ class CreateAndMountEBSVolume(object):
             logging.debug("Device %s is not present" % device)
             return False
 
-    def get_snapshot(self, snapshot_id=None, snapshot_description=None):
-        '''Get snapshot object from the description or snapshot_id.
+    def get_snapshot(self, snapshot_id=None, snapshot_description=None,
+                     snapshot_tags=None, snapshot_volume_id=None):
+        '''Get snapshot object from the snapshot_id, or the description,
+        tags dictionary and volume ID, any of them.
         In case there are many snapshots - take the last created'''
         if snapshot_id:
             snapshot = self.conn.get_all_snapshots(snapshot_ids=[snapshot_id],
                                                    filters={"status": "completed"})[0]
-        elif snapshot_description:
-            snapshot_list = self.conn.get_all_snapshots(owner="self",
-                                                        filters={"description": snapshot_description,
-                                                                 "status": "completed"})
-            if snapshot_list:
-                snapshot = sorted(snapshot_list, key=lambda snapshot: snapshot.start_time)[-1]
+        elif snapshot_description or snapshot_tags or snapshot_volume_id:
+            # Filtered by EC2, so only matching snapshots are listed
+            filters = {"status": "completed"}
+            if snapshot_description:
+                filters["description"] = snapshot_description
+            for tag, value in (snapshot_tags or {}).iteritems():
+                filters["tag:" + tag] = value
+            if snapshot_volume_id:
+                filters["volume-id"] = snapshot_volume_id
+            if self.snapshot_index:
+                snapshot = self.snapshot_index.newest(self.conn, filters)
             else:
-                snapshot = None
+                snapshot = newest_snapshot(iter_snapshots(self.conn, filters))
         else:
             snapshot = None
 
         logging.debug("Snapshot to use: %s" % snapshot)
         return snapshot
 
+    def get_snapshot_set(self, snapshot_ids=None, snapshot_description=None,
+                         snapshot_tags=None, snapshot_volume_id=None):
+        '''Get snapshots of all volumes of a striped set, either listed by snapshot_ids
+        or the set of the last created snapshot found as with get_snapshot'''
+        if snapshot_ids:
+            snapshots = self.conn.get_all_snapshots(snapshot_ids=snapshot_ids,
+                                                    filters={"status": "completed"})
+            if len(snapshots) != len(snapshot_ids):
+                raise Exception("Not all snapshots are found and completed", snapshot_ids)
+            return snapshots
+        latest = self.get_snapshot(snapshot_description=snapshot_description,
+                                   snapshot_tags=snapshot_tags,
+                                   snapshot_volume_id=snapshot_volume_id)
+        if not latest:
+            return []
+        snapshot_set = latest.tags.get(self.SNAPSHOT_SET_TAG)
+        if not snapshot_set:
+            logging.warning("%s has no %s tag, using it alone" % (latest, self.SNAPSHOT_SET_TAG))
+            return [latest]
+        snapshots = list(iter_snapshots(self.conn, {"tag:%s" % self.SNAPSHOT_SET_TAG: snapshot_set,
+                                                    "status": "completed"}))
+        logging.debug("Snapshots of set %s: %s" % (snapshot_set, snapshots))
+        return snapshots
+
+    def get_volume(self, volume_id):
+        '''Returns the volume, None if it is gone'''
+        try:
+            volumes = self.conn.get_all_volumes(volume_ids=[volume_id])
+        except EC2ResponseError, exc:
+            if exc.error_code != "InvalidVolume.NotFound":
+                raise
+            volumes = []
+        if not volumes or volumes[0].status in ("deleting", "deleted", "error"):
+            return None
+        return volumes[0]
+
     def create_volume(self, snapshot=None, size=None, provisioned_iops=None):
         '''Create new volume'''
         if provisioned_iops:
@@ -110,52 +857,79 @@ class CreateAndMountEBSVolume(object):
         logging.info("Created volume %s" % volume)
         return volume
 
+    def wait_for_status(self, volume, status):
+        '''Polls the volume until it gets to the status, backing off
+        exponentially, also when EC2 API throttles us'''
+        started = time.time()
+        delays = backoff_delays(self.API_DELAY, self.API_MAX_DELAY)
+        while volume.status != status:
+            if time.time() - started > self.wait_timeout:
+                raise Exception("Timed out waiting for volume to become %s" % status, volume)
+            logging.debug("%s is %s, waiting for %s" % (volume, volume.status, status))
+            time.sleep(next(delays))
+            try:
+                volume.update()
+            except EC2ResponseError, exc:
+                if exc.error_code != "RequestLimitExceeded":
+                    raise
+                logging.debug("EC2 API throttled us, backing off")
+        logging.debug("%s became %s in %.1f seconds" % (volume, status, time.time() - started))
+
     def attach_volume(self, volume, device, instance_id,
                       delete_on_shutdown=False):
-        '''Attaches the volume to the instance'''
-        while volume.status != 'available':
-            logging.debug("%s is not yet available" % volume)
-            volume.update()
-            time.sleep(self.TIME_SLEEP)
+        '''Attaches the volume to the instance, unless it is attached already'''
+        # Watch for the device before attaching, so its creation can't be missed
+        watcher = DeviceWatcher(device)
         try:
-            volume.attach(instance_id, device)
-            logging.info("Attached %s as %s" % (volume, device))
+            if volume.attach_data and volume.attach_data.instance_id == instance_id:
+                logging.info("%s is already attached as %s" % (volume, volume.attach_data.device))
+            else:
+                self.wait_for_status(volume, 'available')
+                volume.attach(instance_id, device)
+                logging.info("Attached %s as %s" % (volume, device))
         except:
+            watcher.close()
             logging.critical("Failure attaching the volume")
             raise
 
         if delete_on_shutdown:
-            while volume.status != 'in-use':
-                logging.debug("%s is not yet attached" % volume)
-                volume.update()
-                time.sleep(self.TIME_SLEEP)
-            self.conn.modify_instance_attribute(instance_id,
-                                                'blockDeviceMapping', {device: True})
-            logging.info("Device was set to be deleted on instance shutdown")
+            try:
+                self.set_delete_on_shutdown(volume, device, instance_id)
+            except:
+                watcher.close()
+                raise
         # Wait for device to appear on host
-        while not self.check_device(device):
-            time.sleep(self.TIME_SLEEP)
+        started = time.time()
+        if not watcher.wait(self.wait_timeout):
+            raise Exception("Timed out waiting for device to appear", device)
+        logging.debug("Device %s appeared in %.1f seconds" % (device, time.time() - started))
 
-    def format_volume(self, device, format_fs=None):
+    def set_delete_on_shutdown(self, volume, device, instance_id):
+        '''Makes the attached volume deleted on instance shutdown'''
+        self.wait_for_status(volume, 'in-use')
+        self.conn.modify_instance_attribute(instance_id,
+                                            'blockDeviceMapping', {device: True})
+        logging.info("Device was set to be deleted on instance shutdown")
+
+    def format_volume(self, device, format_fs=None, stripe_unit=None, stripes=None,
+                      profile="fast", volume_type=None, size=None):
         '''Unconditionally formats the volume.
-        Will try the best guess on options depending on FS used'''
-        logging.debug("Formatting volume with mkfs.%s" % format_fs)
+        Will try the best guess on options depending on FS used,
+        the profile and type and size in GiB of the volume, see mkfs_options.
+        On striped volume stripe_unit is the chunk size in KiB and
+        stripes is the number of volumes, so FS aligns to them'''
+        command = ([".".join(["mkfs", format_fs])] +
+                   mkfs_options(format_fs, profile, volume_type, size, stripe_unit, stripes) +
+                   [device])
+        logging.debug("Formatting volume with: %s" % " ".join(command))
+        started = time.time()
         try:
-            if "ext" in format_fs:
-                subprocess.check_call([".".join(["mkfs", format_fs]),
-                                       '-q', '-F', device])
-            elif format_fs == "xfs":
-                subprocess.check_call([".".join(["mkfs", format_fs]),
-                                       '-q', '-f', device])
-            else:
-                subprocess.check_call([".".join(["mkfs", format_fs]),
-                                       device])
-
-
-            logging.info("Volume was successfully formatted in %s" % format_fs)
+            subprocess.check_call(command)
         except subprocess.CalledProcessError:
             logging.critical("Failure formatting the volume")
             raise
+        logging.info("Volume was successfully formatted in %s with %s profile in %.1f seconds" %
+                     (format_fs, profile, time.time() - started))
 
     def mount_volume(self, device, mount_dir, mount_options=None):
         '''mounts volume, cap'''
@@ -172,53 +946,238 @@ class CreateAndMountEBSVolume(object):
             raise
         logging.info("Successfully mounted the volume to %s" % mount_dir)
 
+    def create_striped(self, devices, stripe_with="mdadm", raid_device="/dev/md0",
+                       volume_group="data", stripe_unit=256):
+        '''Creates RAID0 or LVM striped volume of the devices, returns its device'''
+        try:
+            if stripe_with == "mdadm":
+                subprocess.check_call(["mdadm", "--create", raid_device, "--run",
+                                       "--level=0", "--chunk=%s" % stripe_unit,
+                                       "--raid-devices=%s" % len(devices)] + devices)
+                striped_device = raid_device
+            else:
+                subprocess.check_call(["pvcreate", "-q"] + devices)
+                subprocess.check_call(["vgcreate", "-q", volume_group] + devices)
+                subprocess.check_call(["lvcreate", "-q", "-i", str(len(devices)),
+                                       "-I", str(stripe_unit), "-l", "100%FREE",
+                                       "-n", self.LOGICAL_VOLUME, volume_group])
+                striped_device = "/dev/%s/%s" % (volume_group, self.LOGICAL_VOLUME)
+        except subprocess.CalledProcessError:
+            logging.critical("Failure creating striped volume with %s" % stripe_with)
+            raise
+        logging.info("Striped %s into %s with %s" % (", ".join(devices), striped_device, stripe_with))
+        return striped_device
+
+    def assemble_striped(self, devices, stripe_with="mdadm", raid_device="/dev/md0",
+                         volume_group="data"):
+        '''Brings up striped volume restored from snapshots, returns its device.
+        Both mdadm and LVM find the order of devices from their metadata'''
+        try:
+            if stripe_with == "mdadm":
+                subprocess.check_call(["mdadm", "--assemble", "--run", raid_device] + devices)
+                striped_device = raid_device
+            else:
+                subprocess.check_call(["pvscan", "-q"])
+                subprocess.check_call(["vgchange", "-q", "-ay", volume_group])
+                striped_device = "/dev/%s/%s" % (volume_group, self.LOGICAL_VOLUME)
+        except subprocess.CalledProcessError:
+            logging.critical("Failure assembling striped volume with %s" % stripe_with)
+            raise
+        logging.info("Assembled %s from %s with %s" % (striped_device, ", ".join(devices), stripe_with))
+        return striped_device
+
+    def prewarm_volume(self, device, mount_dir, hot_paths=None, threads=16, block_size=1024):
+        '''Pre-warms volume restored from snapshot, hot paths relative
+        to mount dir first, block_size is in KiB'''
+        prewarmer = Prewarmer(device, threads, block_size * 1024)
+        if hot_paths:
+            prewarmer.warm_files([os.path.join(mount_dir, path) for path in hot_paths])
+        prewarmer.warm_device()
+
+    def create_and_attach(self, device, snapshot=None, size=None, provisioned_iops=None,
+                          delete_on_shutdown=False):
+        '''Creates volume and attaches it as the device'''
+        volume = self.create_volume(snapshot=snapshot, size=size,
+                                    provisioned_iops=provisioned_iops)
+        self.attach_volume(volume, device, self.instance_id, delete_on_shutdown)
+        return volume
+
+    def setup_striped_volume(self, devices,
+                             snapshot_ids=None,
+                             snapshot_description=None,
+                             snapshot_tags=None,
+                             snapshot_volume_id=None,
+                             mount_dir="/mnt/data",
+                             mount_options=None,
+                             format_fs="xfs",
+                             format_profile="fast",
+                             size=None,
+                             provisioned_iops=None,
+                             delete_on_shutdown=False,
+                             stripe_with="mdadm",
+                             raid_device="/dev/md0",
+                             volume_group="data",
+                             stripe_unit=256,
+                             prewarm=False,
+                             prewarm_hot_paths=None,
+                             prewarm_threads=16,
+                             prewarm_block_size=1024):
+        '''Setup volume striped over the devices.
+        All volumes are created and attached in parallel, size is the total size
+        and provisioned_iops the IOPS of every volume.
+        With prewarm volumes restored from snapshots are read through'''
+        for device in devices:
+            if self.check_device(device):
+                raise Exception("Device is already used", device)
+        if stripe_with == "mdadm" and self.check_device(raid_device):
+            raise Exception("Device is already used", raid_device)
+        if not self.prepare_mount(mount_dir):
+            raise Exception("Cannot use directory for mount", mount_dir)
+
+        if snapshot_ids or snapshot_description or snapshot_tags or snapshot_volume_id:
+            logging.debug("Creating striped volume from snapshots")
+            try:
+                snapshots = self.get_snapshot_set(snapshot_ids, snapshot_description,
+                                                  snapshot_tags, snapshot_volume_id)
+                if len(snapshots) != len(devices):
+                    raise Exception("Got %s snapshots for %s devices" % (len(snapshots), len(devices)))
+                run_parallel(self.create_and_attach,
+                             [(device, snapshot, size and -(-size // len(devices)),
+                               provisioned_iops, delete_on_shutdown)
+                              for device, snapshot in zip(devices, snapshots)])
+                striped_device = self.assemble_striped(devices, stripe_with, raid_device, volume_group)
+                self.mount_volume(striped_device, mount_dir, mount_options)
+                if prewarm:
+                    self.prewarm_volume(striped_device, mount_dir, prewarm_hot_paths,
+                                        prewarm_threads, prewarm_block_size)
+            except:
+                logging.error("Failure setting up the striped volume from snapshots")
+                raise
+        else:
+            try:
+                logging.debug("Creating new striped volume")
+                if not size:
+                    raise Exception("Size is required for new striped volume")
+                volumes = run_parallel(self.create_and_attach,
+                                       [(device, None, -(-size // len(devices)),
+                                         provisioned_iops, delete_on_shutdown)
+                                        for device in devices])
+                striped_device = self.create_striped(devices, stripe_with, raid_device,
+                                                     volume_group, stripe_unit)
+                self.format_volume(striped_device, format_fs, stripe_unit, len(devices),
+                                   format_profile, volumes[0].type,
+                                   sum([volume.size for volume in volumes]))
+                self.mount_volume(striped_device, mount_dir, mount_options)
+            except:
+                logging.error("Failure setting up the new striped volume")
+                raise
+
     def setup_volume(self, snapshot_id=None,
                      snapshot_description=None,
+                     snapshot_tags=None,
+                     snapshot_volume_id=None,
                      device="/dev/sdh",
                      mount_dir="/mnt/data",
                      mount_options=None,
                      format_fs="xfs",
+                     format_profile="fast",
                      size=None,
                      provisioned_iops=None,
-                     delete_on_shutdown=False):
-        ''' Generic function to setup volume'''
-        # Check if device is present
-        if self.check_device(device):
-            raise Exception("Device is already used", device)
+                     delete_on_shutdown=False,
+                     prewarm=False,
+                     prewarm_hot_paths=None,
+                     prewarm_threads=16,
+                     prewarm_block_size=1024,
+                     journal_dir=None,
+                     cache_device=None,
+                     cache_name="ebscache",
+                     cache_size=None,
+                     cache_mode="writethrough",
+                     cache_policy="smq",
+                     cache_block_size=256):
+        ''' Generic function to setup volume.
+        With prewarm volume restored from snapshot is read through.
+        With cache_device, e.g. NVMe instance store, the volume is cached on it
+        with dm-cache, cache_size is in GiB and cache_block_size in KiB.
+        With journal_dir completed steps are recorded there, and the setup
+        interrupted by failure is resumed with the volume already created'''
+        journal = SetupJournal(journal_dir, device, mount_dir, self.instance_id)
+        volume = journal.get("volume_id") and self.get_volume(journal.get("volume_id"))
+        if volume:
+            logging.info("Resuming setup of %s after %s step" % (volume, journal.get("steps")[-1]))
+        else:
+            if journal.get("volume_id"):
+                logging.warning("Volume %s recorded in the journal is gone, starting over" %
+                                journal.get("volume_id"))
+                journal.reset()
+            # Check if device is present
+            if self.check_device(device):
+                raise Exception("Device is already used", device)
 
-        # Check if mount dir is present/mounted, create if needed
-        if not self.prepare_mount(mount_dir):
-            raise Exception("Cannot use directory for mount", mount_dir)
-        # Get from snapshot if defined, otherwise create new and format it
-        if snapshot_id or snapshot_description:
-            logging.debug("Creating from snapshot")
-            try:
-                snapshot = self.get_snapshot(snapshot_id, snapshot_description)
-                if not snapshot:
-                    logging.error("Failure getting the snapshot")
-                    raise Exception("Failure getting the snapshot")
+            # Check if mount dir is present/mounted, create if needed
+            if not self.prepare_mount(mount_dir):
+                raise Exception("Cannot use directory for mount", mount_dir)
+
+        try:
+            if not volume:
+                # Get from snapshot if defined, otherwise create new and format it
+                if snapshot_id or snapshot_description or snapshot_tags or snapshot_volume_id:
+                    logging.debug("Creating from snapshot")
+                    snapshot = self.get_snapshot(snapshot_id, snapshot_description,
+                                                 snapshot_tags, snapshot_volume_id)
+                    if not snapshot:
+                        logging.error("Failure getting the snapshot")
+                        raise Exception("Failure getting the snapshot")
+                else:
+                    logging.debug("Creating new volume")
+                    snapshot = None
                 volume = self.create_volume(snapshot=snapshot, size=size,
                                             provisioned_iops=provisioned_iops)
-                self.attach_volume(volume, device, self.instance_id,
-                                   delete_on_shutdown)
-                self.mount_volume(device, mount_dir, mount_options)
-            except:
+                journal.record("create", volume_id=volume.id, snapshot_id=snapshot and snapshot.id)
+            # Always called, the volume may have been detached since the
+            # journal was written, attach_volume skips an attached one
+            self.attach_volume(volume, device, self.instance_id)
+            if not journal.done("attach"):
+                journal.record("attach")
+            if delete_on_shutdown and not journal.done("delete-on-shutdown"):
+                self.set_delete_on_shutdown(volume, device, self.instance_id)
+                journal.record("delete-on-shutdown")
+            target = device
+            if cache_device:
+                cache = DmCache(cache_name, device, cache_device,
+                                cache_size and cache_size * 1024 ** 3,
+                                cache_mode, cache_policy, cache_block_size * 1024)
+                target = cache.device
+                if is_block_device(target):
+                    logging.info("Cache device %s is already present" % target)
+                else:
+                    # After reboot the journaled cache of this very volume is
+                    # brought back with its metadata, unless the instance store
+                    # lost it. Anything else is a new volume, metadata left on
+                    # the device describes another one and must not be used.
+                    cache.create(fresh=None if journal.done("cache") else True)
+                if not journal.done("cache"):
+                    journal.record("cache")
+            if not journal.get("snapshot_id") and not journal.done("format"):
+                self.format_volume(target, format_fs, profile=format_profile,
+                                   volume_type=volume.type, size=volume.size)
+                journal.record("format")
+            if os.path.ismount(mount_dir):
+                logging.info("%s is already mounted" % mount_dir)
+            else:
+                self.mount_volume(target, mount_dir, mount_options)
+            if not journal.done("mount"):
+                journal.record("mount")
+            if journal.get("snapshot_id") and prewarm and not journal.done("prewarm"):
+                self.prewarm_volume(device, mount_dir, prewarm_hot_paths,
+                                    prewarm_threads, prewarm_block_size)
+                journal.record("prewarm")
+        except:
+            if journal.get("snapshot_id"):
                 logging.error("Failure setting up the volume from snapshot")
-                raise
-        else:
-            try:
-                logging.debug("Creating new volume")
-                volume = self.create_volume(snapshot=None,
-                                            size=size,
-                                            provisioned_iops=provisioned_iops)
-                self.attach_volume(volume, device, self.instance_id,
-                                   delete_on_shutdown)
-                self.format_volume(device, format_fs)
-                self.mount_volume(device, mount_dir, mount_options)
-            except:
+            else:
                 logging.error("Failure setting up the new volume")
-                raise
-
+            raise
 
 def main():
 
@@ -228,10 +1187,20 @@ def main():
 
     group.add_argument("--snapshot-id", "-S",
                        default=None,
-                       help="Snapshot ID to create volume from")
+                       help="Snapshot ID to create volume from, comma separated IDs for striped volume")
     group.add_argument("--snapshot-description", "-T",
                        type=str, default=None,
                        help="The description of latest created snapshot to create volume from")
+    parser.add_argument("--snapshot-tag",
+                        type=str, action="append", default=None,
+                        help="Tag:value the latest snapshot to create volume from has, can be repeated")
+    parser.add_argument("--snapshot-volume-id",
+                        type=str, default=None,
+                        help="Volume ID the latest snapshot to create volume from was made of")
+    parser.add_argument("--snapshot-index",
+                        type=str, default=None,
+                        help="File to keep the latest snapshot found in, so next lookups "
+                        "only list snapshots made since")
     parser.add_argument("--delete-on-shutdown", "-z",
                         action="store_true", default=False,
                         help="delete volume on instance shutdown")
@@ -254,6 +1223,107 @@ def main():
     parser.add_argument("--format-fs",
                         type=str, default="xfs",
                         help="FS to format the volume with, by default XFS")
+    parser.add_argument("--stripes",
+                        type=int, default=1,
+                        help="Number of volumes to stripe together, attached as --device and "
+                        "the following device names. --size is their total size")
+    parser.add_argument("--stripe-with",
+                        type=str, default="mdadm", choices=["mdadm", "lvm"],
+                        help="Stripe volumes with mdadm RAID0 or LVM, by default mdadm")
+    parser.add_argument("--stripe-unit",
+                        type=int, default=256,
+                        help="Stripe chunk size in KiB, by default 256")
+    parser.add_argument("--raid-device",
+                        type=str, default="/dev/md0",
+                        help="mdadm RAID device, by default /dev/md0")
+    parser.add_argument("--volume-group",
+                        type=str, default="data",
+                        help="LVM volume group, by default data")
+    parser.add_argument("--prewarm",
+                        action="store_true", default=False,
+                        help="Read all blocks of volume restored from snapshot after mounting it, "
+                        "so its data is loaded from S3 upfront")
+    parser.add_argument("--prewarm-hot",
+                        type=str, action="append", default=None,
+                        help="File or directory under the mount dir to pre-warm first, can be repeated")
+    parser.add_argument("--prewarm-threads",
+                        type=int, default=16,
+                        help="Number of threads reading the volume, by default 16")
+    parser.add_argument("--prewarm-block-size",
+                        type=int, default=1024,
+                        help="Size of reads in KiB, by default 1024")
+    parser.add_argument("--cache-device",
+                        type=str, default=None,
+                        help="Fast local device, e.g. NVMe instance store, to cache the volume on with "
+                        "dm-cache. Not used for striped volume")
+    parser.add_argument("--cache-name",
+                        type=str, default="ebscache",
+                        help="Name of the cache device in /dev/mapper, by default ebscache")
+    parser.add_argument("--cache-size",
+                        type=int, default=None,
+                        help="Cache size in GiB, by default all of the cache device")
+    parser.add_argument("--cache-mode",
+                        type=str, default="writethrough", choices=DmCache.MODES,
+                        help="Cache mode, by default writethrough. Snapshots of the volume cached in "
+                        "writeback mode miss dirty blocks")
+    parser.add_argument("--cache-policy",
+                        type=str, default="smq",
+                        help="dm-cache policy, by default smq")
+    parser.add_argument("--cache-block-size",
+                        type=int, default=256,
+                        help="Cache block size in KiB, multiple of 32, by default 256")
+    parser.add_argument("--cache-stats",
+                        action="store_true", default=False,
+                        help="Only print JSON usage and hit rates of the cache device")
+    parser.add_argument("--journal-dir",
+                        type=str, default="/var/lib/setupvolume",
+                        help="Directory to record completed setup steps in, so failed setup is resumed "
+                        "by the next run, by default /var/lib/setupvolume. Empty to disable. "
+                        "Not used for striped volume")
+    parser.add_argument("--spec",
+                        type=str, default=None,
+                        help="YAML or JSON file listing several volumes to set up at once, as "
+                        "entries with keys of these options, e.g. device, mount-dir, snapshot-tag, "
+                        "size, provisioned-iops. Options not in the entry are taken from the command line")
+    parser.add_argument("--benchmark",
+                        action="store_true", default=False,
+                        help="Benchmark the volume once it is mounted, exit with 2 if it is slower than "
+                        "--benchmark-min-iops or --benchmark-min-mbps")
+    parser.add_argument("--benchmark-only",
+                        action="store_true", default=False,
+                        help="Only benchmark the volume already mounted to --mount-dir, "
+                        "without creating anything")
+    parser.add_argument("--benchmark-threads",
+                        type=int, default=4,
+                        help="Threads doing I/O, by default 4")
+    parser.add_argument("--benchmark-queue-depth",
+                        type=int, default=4,
+                        help="I/Os in flight per thread, by default 4")
+    parser.add_argument("--benchmark-size",
+                        type=int, default=1024,
+                        help="Size of the test file in MiB, by default 1024")
+    parser.add_argument("--benchmark-runtime",
+                        type=int, default=10,
+                        help="Seconds to run every workload for, by default 10")
+    parser.add_argument("--no-direct-io",
+                        dest="direct_io", action="store_false", default=True,
+                        help="Benchmark through the page cache")
+    parser.add_argument("--benchmark-report",
+                        type=str, default="-",
+                        help="File to write JSON report to, by default stdout")
+    parser.add_argument("--benchmark-min-iops",
+                        type=int, default=None,
+                        help="Least random read and write IOPS the volume must have")
+    parser.add_argument("--benchmark-min-mbps",
+                        type=float, default=None,
+                        help="Least sequential read and write MB/s the volume must have")
+    parser.add_argument("--wait-timeout",
+                        type=int, default=900,
+                        help="Seconds to wait for the volume to be attached and appear on host")
+    parser.add_argument("--format-profile",
+                        type=str, default="fast", choices=["fast", "plain"],
+                        help="fast: mkfs options chosen by volume type and size, no discard and "
+                        "lazy init, plain: mkfs defaults. By default fast")
     parser.add_argument("--loglevel",
                         type=str, default='INFO',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL',
@@ -267,40 +1337,209 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s: %(message)s',
+    if args.spec and (args.benchmark or args.benchmark_only):
+        parser.error("--benchmark cannot be used with --spec")
+
+    if args.cache_stats:
+        stats = cache_stats(args.cache_name)
+        if stats is None:
+            sys.stderr.write("No cache device %s\n" % args.cache_name)
+            sys.exit(1)
+        json.dump(stats, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+        sys.exit(0)
+
+    if args.spec:
+        # Volumes are set up in threads named after their mount dirs
+        log_format = '%(asctime)s %(name)s %(threadName)s %(levelname)s: %(message)s'
+    else:
+        log_format = '%(asctime)s %(name)s %(levelname)s: %(message)s'
+    logging.basicConfig(format=log_format,
                         level=getattr(logging, args.loglevel.upper(), None))
     # Output will be like: "2013-05-12 13:00:09,934 root WARNING: some warning text"
     logging.info("====================================================")
-    logging.info("Started setup of volume")
+    if args.benchmark_only:
+        logging.info("Started benchmark of volume")
+    else:
+        logging.info("Started setup of volume")
+        setup(args)
+
+    if args.benchmark or args.benchmark_only:
+        if args.stripes > 1:
+            if args.stripe_with == "lvm":
+                device = "/dev/%s/%s" % (args.volume_group, CreateAndMountEBSVolume.LOGICAL_VOLUME)
+            else:
+                device = args.raid_device
+        else:
+            device = args.device
+        try:
+            passed = run_benchmark(args, is_block_device(device) and device or None)
+        except:
+            logging.exception("Failure benchmarking the volume")
+            sys.exit(1)
+        if not passed:
+            logging.error("Volume is slower than required")
+            sys.exit(2)
+        logging.info("Finished benchmark of volume")
+
+    logging.info("====================================================")
+
 
-    # Provides AWS_ID and AWS_SECRET for Boto connection
-    # NOTE: we rely on:
-    #   * ~/.boto or /etc/boto.cfg config files or
-    #   * AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environmental variables
-    # to automatically provide credentials to boto.
+def setup(args):
+    '''Creates and mounts the volume, or all volumes of the spec,
+    as set by the args, exits on failure'''
+    # See ec2common.get_connection for where boto gets credentials from
     try:
-        conn = boto.ec2.connect_to_region(get_instance_metadata()["placement"]["availability-zone"][:-1])
+        conn = ec2common.get_connection()
     except:
         logging.exception("Failure getting EC2 API connection")
         sys.exit(1)
 
     try:
-        CreateAndMountEBSVolume(conn).setup_volume(snapshot_id=args.snapshot_id,
-                                                   snapshot_description=args.snapshot_description,
-                                                   device=args.device,
-                                                   mount_dir=args.mount_dir,
-                                                   mount_options=args.mount_options,
-                                                   format_fs=args.format_fs,
-                                                   size=args.size,
-                                                   provisioned_iops=args.provisioned_iops,
-                                                   delete_on_shutdown=args.delete_on_shutdown)
+        volume_setup = CreateAndMountEBSVolume(conn, args.wait_timeout, args.snapshot_index)
+        if args.spec:
+            volumes = load_spec(args.spec, args)
+            failed = setup_all(volume_setup, volumes)
+            if failed:
+                raise Exception("Failure setting up volumes for %s" % ", ".join(failed))
+        else:
+            setup_from_args(volume_setup, args)
     except:
         logging.exception("Failure setting up the volume")
         sys.exit(1)
     else:
         logging.info("Finished setup of volume")
 
-    logging.info("====================================================")
+
+# Options of the whole run, which spec entries cannot set
+GLOBAL_OPTIONS = ("spec", "snapshot_index", "wait_timeout", "loglevel", "cache_stats")
+
+
+def load_spec(path, defaults):
+    '''Reads spec of volumes, list of entries, or a mapping with such list in
+    "volumes", where keys are long names of the options. Returns args of
+    every volume, options missing in its entry are taken from defaults'''
+    with open(path) as spec_file:
+        if yaml:
+            spec = yaml.safe_load(spec_file)
+        else:
+            spec = json.load(spec_file)
+    if isinstance(spec, dict):
+        spec = spec.get("volumes")
+    if not isinstance(spec, list) or not spec:
+        raise Exception("No volumes in the spec", path)
+    volumes = []
+    for entry in spec:
+        volume_args = argparse.Namespace(**vars(defaults))
+        for key, value in entry.iteritems():
+            name = key.replace("-", "_")
+            if name in GLOBAL_OPTIONS or not hasattr(volume_args, name) or name.startswith("benchmark"):
+                raise Exception("Unknown option in the spec", key)
+            setattr(volume_args, name, value)
+        volumes.append(volume_args)
+    users = {}
+    for volume_args in volumes:
+        for resource in exclusive_resources(volume_args):
+            if resource in users:
+                raise Exception("Volumes in the spec share %s" % resource[0], resource[1],
+                                users[resource], volume_args.mount_dir)
+            users[resource] = volume_args.mount_dir
+    return volumes
+
+
+def exclusive_resources(args):
+    '''Returns list of (kind, name) of everything the volume setup takes for
+    itself: mount dir, devices of all stripes and of the cache, RAID device,
+    volume group and cache name'''
+    resources = [("mount dir", args.mount_dir)]
+    resources += [("device", device) for device in device_names(args.device, args.stripes)]
+    if args.stripes > 1:
+        if args.stripe_with == "mdadm":
+            resources.append(("RAID device", args.raid_device))
+        else:
+            resources.append(("volume group", args.volume_group))
+    elif args.cache_device:
+        resources += [("device", args.cache_device), ("cache name", args.cache_name)]
+    return resources
+
+
+def setup_all(volume_setup, volumes):
+    '''Sets up the volumes at once, each in its own thread named after its
+    mount dir. Returns mount dirs of the volumes that failed'''
+    failed = []
+
+    def run(volume_args):
+        started = time.time()
+        logging.info("Started setup of volume on %s for %s" % (volume_args.device, volume_args.mount_dir))
+        try:
+            setup_from_args(volume_setup, volume_args)
+        except:
+            logging.exception("Failure setting up the volume for %s" % volume_args.mount_dir)
+            failed.append(volume_args.mount_dir)
+        else:
+            logging.info("Finished setup of volume for %s in %.1f seconds" %
+                         (volume_args.mount_dir, time.time() - started))
+
+    threads = [threading.Thread(target=run, args=(volume_args,), name=volume_args.mount_dir)
+               for volume_args in volumes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failed
+
+
+def setup_from_args(volume_setup, args):
+    '''Creates and mounts one volume, striped or not, as set by the args'''
+    if isinstance(args.snapshot_tag, dict):
+        snapshot_tags = args.snapshot_tag
+    else:
+        snapshot_tags = dict(tag.split(":", 1) for tag in args.snapshot_tag or [])
+    if args.stripes > 1:
+        volume_setup.setup_striped_volume(device_names(args.device, args.stripes),
+                                          snapshot_ids=args.snapshot_id and args.snapshot_id.split(","),
+                                          snapshot_description=args.snapshot_description,
+                                          snapshot_tags=snapshot_tags,
+                                          snapshot_volume_id=args.snapshot_volume_id,
+                                          mount_dir=args.mount_dir,
+                                          mount_options=args.mount_options,
+                                          format_fs=args.format_fs,
+                                          format_profile=args.format_profile,
+                                          size=args.size,
+                                          provisioned_iops=args.provisioned_iops,
+                                          delete_on_shutdown=args.delete_on_shutdown,
+                                          stripe_with=args.stripe_with,
+                                          raid_device=args.raid_device,
+                                          volume_group=args.volume_group,
+                                          stripe_unit=args.stripe_unit,
+                                          prewarm=args.prewarm,
+                                          prewarm_hot_paths=args.prewarm_hot,
+                                          prewarm_threads=args.prewarm_threads,
+                                          prewarm_block_size=args.prewarm_block_size)
+    else:
+        volume_setup.setup_volume(snapshot_id=args.snapshot_id,
+                                  snapshot_description=args.snapshot_description,
+                                  snapshot_tags=snapshot_tags,
+                                  snapshot_volume_id=args.snapshot_volume_id,
+                                  device=args.device,
+                                  mount_dir=args.mount_dir,
+                                  mount_options=args.mount_options,
+                                  format_fs=args.format_fs,
+                                  format_profile=args.format_profile,
+                                  size=args.size,
+                                  provisioned_iops=args.provisioned_iops,
+                                  delete_on_shutdown=args.delete_on_shutdown,
+                                  prewarm=args.prewarm,
+                                  prewarm_hot_paths=args.prewarm_hot,
+                                  prewarm_threads=args.prewarm_threads,
+                                  prewarm_block_size=args.prewarm_block_size,
+                                  journal_dir=args.journal_dir,
+                                  cache_device=args.cache_device,
+                                  cache_name=args.cache_name,
+                                  cache_size=args.cache_size,
+                                  cache_mode=args.cache_mode,
+                                  cache_policy=args.cache_policy,
+                                  cache_block_size=args.cache_block_size)
 
 if __name__ == '__main__':
     main()
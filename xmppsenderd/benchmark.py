@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+
+# Load test of xmppsenderd against local fake XMPP server.
+# The fake server accepts client streams, SASL PLAIN with any password,
+# resource binding, XEP-0198 stream management with resumption
+# and swallows all messages, counting them.
+# The daemon is started as a child process, driven over HTTP with
+# configurable concurrency, and its throughput, /send latency and
+# resource use are reported.
+# Example: benchmark.py --messages 5000 --concurrency 50
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import logging
+import httplib
+import tempfile
+import argparse
+import threading
+import subprocess
+import SocketServer
+import xml.parsers.expat
+
+STREAM_HEADER = ("<?xml version='1.0'?>"
+                 "<stream:stream xmlns='jabber:client' "
+                 "xmlns:stream='http://etherx.jabber.org/streams' "
+                 "id='%s' from='%s' version='1.0'>")
+SASL_FEATURES = ("<stream:features>"
+                 "<mechanisms xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>"
+                 "<mechanism>PLAIN</mechanism></mechanisms>"
+                 "</stream:features>")
+SESSION_FEATURES = ("<stream:features>"
+                    "<bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'/>"
+                    "<session xmlns='urn:ietf:params:xml:ns:xmpp-session'/>"
+                    "<sm xmlns='urn:xmpp:sm:3'/>"
+                    "</stream:features>")
+SASL_SUCCESS = "<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>"
+BIND_RESULT = ("<iq type='result' id='%s'>"
+               "<bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'><jid>%s</jid></bind>"
+               "</iq>")
+ROSTER_RESULT = "<iq type='result' id='%s'><query xmlns='jabber:iq:roster'/></iq>"
+IQ_RESULT = "<iq type='result' id='%s'/>"
+SM_ENABLED = "<enabled xmlns='urn:xmpp:sm:3' id='%s' resume='true'/>"
+SM_RESUMED = "<resumed xmlns='urn:xmpp:sm:3' previd='%s' h='%s'/>"
+SM_FAILED = "<failed xmlns='urn:xmpp:sm:3'><item-not-found xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></failed>"
+SM_ACK = "<a xmlns='urn:xmpp:sm:3' h='%s'/>"
+
+
+class FakeXMPPHandler(SocketServer.BaseRequestHandler):
+    """
+    One client connection to the fake XMPP server.
+
+    Top level elements of the stream are handled as stanzas,
+    a new parser is started after SASL success for the restarted stream.
+    """
+
+    def setup(self):
+        self.authenticated = False
+        self.restart = False
+        self.jid = None
+        # Stream management state, shared with resumed streams
+        self.sm = None
+        self._new_parser()
+
+    def _new_parser(self):
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._data
+        self.depth = 0
+        self.stanza = None
+
+    def handle(self):
+        self.server.register(self.request)
+        while True:
+            try:
+                data = self.request.recv(65536)
+            except socket.error:
+                break
+            if not data:
+                break
+            self.parser.Parse(data)
+            if self.restart:
+                self.restart = False
+                self._new_parser()
+
+    def _send(self, data):
+        self.request.sendall(data)
+
+    def _start(self, name, attrs):
+        self.depth += 1
+        if self.depth == 1:
+            self._send(STREAM_HEADER % (id(self), self.server.domain))
+            self._send(SESSION_FEATURES if self.authenticated else SASL_FEATURES)
+        elif self.depth == 2:
+            self.stanza = {'name': name, 'attrs': attrs, 'children': [], 'text': {}}
+        elif self.stanza is not None:
+            self.stanza['children'].append(name)
+            self.element = name
+
+    def _data(self, data):
+        if self.depth > 2 and self.stanza is not None:
+            self.stanza['text'][self.element] = self.stanza['text'].get(self.element, '') + data
+
+    def _end(self, name):
+        self.depth -= 1
+        if self.depth == 1 and self.stanza is not None:
+            self._handle_stanza(self.stanza)
+            self.stanza = None
+
+    def _handle_stanza(self, stanza):
+        name, attrs, children = stanza['name'], stanza['attrs'], stanza['children']
+        if self.sm is not None and name in ('message', 'iq', 'presence'):
+            self.sm['h'] += 1
+        if name == 'auth':
+            self.authenticated = True
+            self.restart = True
+            self._send(SASL_SUCCESS)
+        elif name == 'iq':
+            if 'bind' in children:
+                self.jid = "%s/%s" % (self.server.bare_jid, stanza['text'].get('resource', 'fake'))
+                self._send(BIND_RESULT % (attrs.get('id'), self.jid))
+            elif 'query' in children and attrs.get('type') == 'get':
+                self._send(ROSTER_RESULT % attrs.get('id'))
+            elif attrs.get('type') in ('get', 'set'):
+                self._send(IQ_RESULT % attrs.get('id'))
+        elif name == 'message':
+            self.server.received(stanza['text'].get('body', ''))
+        elif name == 'enable':
+            sm_id = str(id(self))
+            self.sm = self.server.sm_sessions[sm_id] = {'h': 0}
+            self._send(SM_ENABLED % sm_id)
+        elif name == 'resume':
+            self.sm = self.server.sm_sessions.get(attrs.get('previd'))
+            if self.sm is None:
+                self._send(SM_FAILED)
+            else:
+                self.server.resumed += 1
+                self._send(SM_RESUMED % (attrs.get('previd'), self.sm['h']))
+        elif name == 'r' and self.sm is not None:
+            self._send(SM_ACK % self.sm['h'])
+
+
+class FakeXMPPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''Counts messages and lines in them, merged messages carry several lines'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, bare_jid):
+        SocketServer.TCPServer.__init__(self, server_address, FakeXMPPHandler)
+        self.bare_jid = bare_jid
+        self.domain = bare_jid.split("@")[-1]
+        self.lock = threading.Lock()
+        self.stanzas = 0
+        self.lines = 0
+        self.last_received = None
+        self.sm_sessions = {}
+        self.resumed = 0
+        self.connections = []
+
+    def register(self, connection):
+        with self.lock:
+            self.connections.append(connection)
+
+    def drop_connections(self):
+        '''Drop all client connections without closing streams,
+        like a load balancer idle timeout does'''
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def received(self, body):
+        with self.lock:
+            self.stanzas += 1
+            self.lines += len(body.splitlines())
+            self.last_received = time.time()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def ready_sessions(port):
+    '''Read number of ready sessions from the daemon metrics'''
+    try:
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=5)
+        connection.request('GET', '/metrics')
+        body = connection.getresponse().read()
+    except (socket.error, httplib.HTTPException):
+        return 0
+    for line in body.splitlines():
+        if line.startswith('xmppsenderd_ready_sessions '):
+            return int(float(line.split()[1]))
+    return 0
+
+
+def process_usage(pid):
+    '''Returns CPU seconds and peak RSS in KiB of the process from /proc'''
+    with open('/proc/%s/stat' % pid) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    # utime and stime, fields 14 and 15 of stat
+    cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+    peak_rss = 0
+    with open('/proc/%s/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                peak_rss = int(line.split()[1])
+    return cpu, peak_rss
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def drive(port, messages, concurrency, recipients):
+    '''Send messages over concurrency keep-alive connections.
+    Returns sorted list of latencies and number of failed requests'''
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+    counter = iter(xrange(messages))
+
+    def client():
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+        own_latencies = []
+        own_failures = 0
+        while True:
+            with lock:
+                number = next(counter, None)
+            if number is None:
+                break
+            path = "/send?to=user%s@localhost&msg=benchmark%%20message%%20%s" % (
+                number % recipients, number)
+            started = time.time()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 400:
+                    own_failures += 1
+            except (socket.error, httplib.HTTPException):
+                own_failures += 1
+                connection.close()
+                connection = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+                continue
+            own_latencies.append(time.time() - started)
+        connection.close()
+        with lock:
+            latencies.extend(own_latencies)
+            failures[0] += own_failures
+
+    clients = [threading.Thread(target=client) for unused in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return sorted(latencies), failures[0]
+
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='xmppsenderd-benchmark-')
+    bare_jid = 'bench@localhost'
+    xmpp_server = FakeXMPPServer(('127.0.0.1', free_port()), bare_jid)
+    server_thread = threading.Thread(target=xmpp_server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    password_file = os.path.join(workdir, 'password')
+    with open(password_file, 'w') as password:
+        password.write('benchmark\n')
+    http_port = free_port()
+    daemon_args = [sys.executable,
+                   os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xmppsenderd.py'),
+                   '--port', str(http_port),
+                   '--jid', bare_jid + '/bench',
+                   '--to', 'user@localhost',
+                   '--server', '127.0.0.1:%s' % xmpp_server.server_address[1],
+                   '--no-tls',
+                   '--password-file', password_file,
+                   '--queue-file', os.path.join(workdir, 'queue.db'),
+                   '--pool-size', str(args.pool_size),
+                   '--workers', str(args.workers),
+                   '--delivery-workers', str(args.delivery_workers),
+                   '--rate', '0',
+                   '--dedup-ttl', '0'] + args.daemon_args
+    logging.debug("Starting daemon: %s" % " ".join(daemon_args))
+    with open(os.path.join(workdir, 'daemon.log'), 'w') as daemon_log:
+        daemon = subprocess.Popen(daemon_args, stdout=daemon_log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.time() + args.startup_timeout
+        while ready_sessions(http_port) < args.pool_size:
+            if daemon.poll() is not None or time.time() > deadline:
+                raise Exception("Daemon didn't start, see %s" % os.path.join(workdir, 'daemon.log'))
+            time.sleep(0.2)
+
+        cpu_before, unused = process_usage(daemon.pid)
+        dropping = threading.Event()
+        if args.drop_interval:
+            def dropper():
+                while not dropping.wait(args.drop_interval):
+                    xmpp_server.drop_connections()
+            drop_thread = threading.Thread(target=dropper)
+            drop_thread.daemon = True
+            drop_thread.start()
+        started = time.time()
+        latencies, failures = drive(http_port, args.messages, args.concurrency, args.recipients)
+        http_elapsed = time.time() - started
+        dropping.set()
+
+        # Wait for the queue to drain into the fake server
+        deadline = time.time() + args.drain_timeout
+        while xmpp_server.lines < args.messages - failures and time.time() < deadline:
+            time.sleep(0.05)
+        delivered_elapsed = (xmpp_server.last_received or time.time()) - started
+        cpu_after, peak_rss = process_usage(daemon.pid)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        xmpp_server.shutdown()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'messages': args.messages,
+        'concurrency': args.concurrency,
+        'failed_requests': failures,
+        'requests_per_second': len(latencies) / http_elapsed,
+        'delivered_messages': xmpp_server.lines,
+        'delivered_stanzas': xmpp_server.stanzas,
+        'delivered_messages_per_second': xmpp_server.lines / delivered_elapsed,
+        'latency_p50_ms': percentile(latencies, 0.50) * 1000,
+        'latency_p95_ms': percentile(latencies, 0.95) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'latency_max_ms': percentile(latencies, 1) * 1000,
+        'daemon_cpu_seconds': cpu_after - cpu_before,
+        'daemon_peak_rss_kib': peak_rss,
+        'resumed_streams': xmpp_server.resumed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test xmppsenderd against local fake XMPP server")
+    parser.add_argument("--messages", "-n",
+                        type=int, default=2000,
+                        help="Number of /send requests to make")
+    parser.add_argument("--concurrency", "-c",
+                        type=int, default=20,
+                        help="Number of concurrent HTTP clients")
+    parser.add_argument("--recipients", "-r",
+                        type=int, default=100,
+                        help="Number of distinct recipients to spread messages over")
+    parser.add_argument("--pool-size",
+                        type=int, default=2,
+                        help="XMPP sessions of the daemon")
+    parser.add_argument("--workers",
+                        type=int, default=16,
+                        help="HTTP worker threads of the daemon")
+    parser.add_argument("--delivery-workers",
+                        type=int, default=2,
+                        help="Delivery worker threads of the daemon")
+    parser.add_argument("--drop-interval",
+                        type=float, default=0,
+                        help="Drop daemon connections to the fake server every that many seconds "
+                             "while requests are made")
+    parser.add_argument("--startup-timeout",
+                        type=int, default=30,
+                        help="Seconds to wait for daemon sessions to be ready")
+    parser.add_argument("--drain-timeout",
+                        type=int, default=120,
+                        help="Seconds to wait for all messages to reach the fake server")
+    parser.add_argument("--keep-workdir",
+                        action="store_true", default=False,
+                        help="Keep daemon log and queue file after the run")
+    parser.add_argument("--json",
+                        action="store_true", default=False,
+                        help="Print results as JSON")
+    parser.add_argument("--loglevel",
+                        type=str, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL',
+                                 'debug', 'info', 'warning', 'error', 'critical'],
+                        help="set output verbosity level")
+    parser.add_argument("daemon_args",
+                        nargs=argparse.REMAINDER,
+                        help="Extra options passed to xmppsenderd after --")
+
+    args = parser.parse_args()
+    if args.daemon_args and args.daemon_args[0] == '--':
+        args.daemon_args = args.daemon_args[1:]
+
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s: %(message)s',
+                        level=getattr(logging, args.loglevel.upper(), None))
+
+    try:
+        results = run_benchmark(args)
+    except:
+        logging.exception("Failure running benchmark")
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(results, sort_keys=True, indent=4, separators=(',', ': ')))
+    else:
+        for key in sorted(results):
+            print("%-32s %s" % (key, round(results[key], 2)))
+    if results['delivered_messages'] < results['messages'] - results['failed_requests']:
+        logging.error("Not all messages were delivered")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Minimal Prometheus metrics for xmppsenderd.
+# Metrics register themselves on creation and render() returns all of them
+# in Prometheus text exposition format.
+
+import threading
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if pairs:
+        return "{%s}" % ",".join(pairs)
+    return ""
+
+
+class Counter(object):
+    '''Monotonically increasing value, optionally split by labels'''
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, labels=()):
+        labels = tuple(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labels:
+            values = [((), 0)]
+        return [(self.name + _format_labels(self.labels, label_values), value)
+                for label_values, value in values]
+
+
+class Gauge(object):
+    '''Value read from the callback at every render'''
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        REGISTRY.append(self)
+
+    def samples(self):
+        if self.callback is None:
+            return []
+        return [(self.name, self.callback())]
+
+
+class Histogram(object):
+    '''Distribution of observed values in cumulative buckets'''
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * len(self.buckets)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value):
+        with self._lock:
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[index] += 1
+                    break
+            self._count += 1
+            self._sum += value
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            count = self._count
+            total = self._sum
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append(("%s_bucket{le=\"%s\"}" % (self.name, bound), cumulative))
+        samples.append(("%s_bucket{le=\"+Inf\"}" % self.name, count))
+        samples.append(("%s_count" % self.name, count))
+        samples.append(("%s_sum" % self.name, total))
+        return samples
+
+
+def render():
+    '''Returns all registered metrics in Prometheus text format'''
+    lines = []
+    for metric in REGISTRY:
+        lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+        lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+        for name, value in metric.samples():
+            lines.append("%s %s" % (name, repr(float(value))))
+    return "\n".join(lines) + "\n"
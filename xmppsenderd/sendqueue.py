@@ -0,0 +1,253 @@
+# Durable queue of messages waiting to be sent by xmppsenderd.
+# Messages are kept in SQLite database in WAL mode, so anything
+# accepted by the daemon survives its restart or XMPP server outage.
+
+import time
+import random
+import sqlite3
+import logging
+import threading
+
+# Values of the claimed column
+PENDING, CLAIMED, SENT = 0, 1, 2
+
+
+class SendQueue(object):
+    """
+    SQLite backed queue of messages.
+
+    Delivery workers claim messages, mark them sent once written to the
+    stream, then either mark them done or put them back with exponential
+    backoff to be retried.
+
+    Messages put with coalesce, e.g. by /batch, that are pending to the
+    same recipient are claimed together, so they go out as one multi-line
+    message. With coalesce_window set, such messages put within that many
+    seconds are merged as well. Other messages always go out on their own.
+
+    Messages of higher priority are claimed first, and workers can
+    claim only the ones of some priority and above, so urgent
+    messages don't wait behind the bulk.
+
+    Messages to one recipient are claimed in the order they were put,
+    only higher priority ones overtake the rest. A message is not
+    claimed while an earlier one to the recipient is still pending,
+    e.g. waiting for retry, or claimed and not yet sent, that is
+    written to the stream. Sent messages only wait for the ack, the
+    stream keeps their order, unless the recipient moves to another
+    session in between.
+    """
+
+    # Condition on a message aliased as message, true if no earlier one
+    # to the recipient with the same or higher priority is still unsent
+    FIRST_IN_ORDER = ("NOT EXISTS (SELECT 1 FROM messages AS earlier INDEXED BY messages_order "
+                      "WHERE earlier.recipient = message.recipient AND earlier.claimed IN (?, ?) "
+                      "AND earlier.id < message.id AND earlier.priority >= message.priority) ")
+
+    def __init__(self, path, retry_delay=1, max_retry_delay=300,
+                 coalesce_window=0, max_coalesce=50):
+        self.path = path
+        self.coalesce_window = coalesce_window
+        self.max_coalesce = max_coalesce
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        # One connection shared by all threads, serialized with the lock.
+        # isolation_level=None means autocommit, every statement is durable
+        # once it returns.
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # In WAL mode NORMAL is still safe against daemon crashes,
+            # only an OS crash may lose the last committed messages.
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS messages ("
+                               "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "recipient TEXT NOT NULL, "
+                               "body TEXT NOT NULL, "
+                               "created REAL NOT NULL, "
+                               "next_attempt REAL NOT NULL, "
+                               "attempts INTEGER NOT NULL DEFAULT 0, "
+                               "claimed INTEGER NOT NULL DEFAULT 0, "
+                               "kind TEXT NOT NULL DEFAULT 'chat', "
+                               "priority INTEGER NOT NULL DEFAULT 0, "
+                               "coalesce INTEGER NOT NULL DEFAULT 0)")
+            # Queue files created by older versions miss the later columns
+            self._add_column("kind TEXT NOT NULL DEFAULT 'chat'")
+            self._add_column("priority INTEGER NOT NULL DEFAULT 0")
+            self._add_column("coalesce INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS messages_ready "
+                               "ON messages (claimed, next_attempt)")
+            # Matches the claim order, so the next message is found without sorting
+            self._conn.execute("CREATE INDEX IF NOT EXISTS messages_priority "
+                               "ON messages (claimed, priority DESC, next_attempt)")
+            # Replaced by messages_order
+            self._conn.execute("DROP INDEX IF EXISTS messages_recipient")
+            self._conn.execute("DROP INDEX IF EXISTS messages_coalesce")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS messages_order "
+                               "ON messages (recipient, claimed, id)")
+            # Messages claimed by the previous run were never confirmed
+            released = self._conn.execute("UPDATE messages SET claimed = ? "
+                                          "WHERE claimed != ?", (PENDING, PENDING)).rowcount
+        if released:
+            logging.info("Requeued %s messages left in flight by previous run" % released)
+
+    def _add_column(self, definition):
+        name = definition.split()[0]
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(messages)")]
+        if name not in columns:
+            self._conn.execute("ALTER TABLE messages ADD COLUMN %s" % definition)
+
+    def put(self, recipient, body, coalesce=False, kind='chat', priority=0):
+        '''Store the message and wake up a delivery worker'''
+        return self.put_many([(recipient, body)], coalesce, kind, priority)[0]
+
+    def put_many(self, messages, coalesce=False, kind='chat', priority=0):
+        '''Store list of (recipient, body) messages in one transaction.
+        With coalesce set the messages are merged with others put with
+        coalesce to the same recipient, waiting coalesce_window seconds
+        for them unless their priority is above 0.
+        kind is the XMPP message type, chat or groupchat for rooms'''
+        now = time.time()
+        next_attempt = now
+        if coalesce and priority <= 0:
+            next_attempt += self.coalesce_window
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                message_ids = [self._conn.execute("INSERT INTO messages "
+                                                  "(recipient, body, created, next_attempt, "
+                                                  "kind, priority, coalesce) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                                  (recipient, body, now, next_attempt,
+                                                   kind, priority, int(bool(coalesce)))).lastrowid
+                               for recipient, body in messages]
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            self._changed.notify_all()
+        return message_ids
+
+    def claim(self, timeout=None, min_priority=None):
+        '''Take the oldest message of the highest priority ready for delivery,
+        if it was put with coalesce together with other such pending messages
+        to the same recipient.
+        With min_priority only messages of that priority and above are taken.
+        Returns (ids, recipient, body, attempts, kind) or None on timeout'''
+        deadline = timeout is not None and time.time() + timeout
+        if min_priority is None:
+            min_priority = -2 ** 31
+        with self._lock:
+            while True:
+                now = time.time()
+                row = self._conn.execute("SELECT id, recipient, body, attempts, kind, priority, coalesce "
+                                         "FROM messages AS message "
+                                         "WHERE claimed = ? AND next_attempt <= ? AND priority >= ? AND "
+                                         + self.FIRST_IN_ORDER +
+                                         "ORDER BY priority DESC, next_attempt, id LIMIT 1",
+                                         (PENDING, now, min_priority, PENDING, CLAIMED)).fetchone()
+                if row and row[6]:
+                    return self._claim_recipient(row[0], row[1], row[4], row[5], now)
+                if row:
+                    self._conn.execute("UPDATE messages SET claimed = ? WHERE id = ?", (CLAIMED, row[0]))
+                    return [row[0]], row[1], row[2], row[3], row[4]
+                # Sleep until something is put or the next retry is due
+                wait = self._next_attempt_in(now, min_priority)
+                if deadline:
+                    if now >= deadline:
+                        return None
+                    wait = min(wait, deadline - now)
+                self._changed.wait(wait)
+
+    def _claim_recipient(self, first_id, recipient, kind, priority, now):
+        # Take the rest of the coalescing window as well, in the order
+        # messages were put, up to the first one that can't be merged,
+        # so merged lines keep their order and nothing is overtaken.
+        rows = self._conn.execute("SELECT id, body, attempts, kind, coalesce, next_attempt FROM messages "
+                                  "INDEXED BY messages_order WHERE recipient = ? AND claimed = ? "
+                                  "AND id >= ? AND priority = ? ORDER BY id LIMIT ?",
+                                  (recipient, PENDING, first_id, priority, self.max_coalesce)).fetchall()
+        for count, row in enumerate(rows):
+            if row[3] != kind or not row[4] or row[5] > now + self.coalesce_window:
+                rows = rows[:count]
+                break
+        message_ids = [row[0] for row in rows]
+        self._conn.executemany("UPDATE messages SET claimed = ? WHERE id = ?",
+                               [(CLAIMED, message_id) for message_id in message_ids])
+        body = "\n".join(row[1] for row in rows)
+        attempts = max(row[2] for row in rows)
+        return message_ids, recipient, body, attempts, kind
+
+    def _next_attempt_in(self, now, min_priority):
+        # Messages waiting for earlier ones are woken up by sent() or retry()
+        next_attempt = self._conn.execute("SELECT MIN(next_attempt) FROM messages AS message "
+                                          "WHERE claimed = ? AND priority >= ? AND " + self.FIRST_IN_ORDER,
+                                          (PENDING, min_priority, PENDING, CLAIMED)).fetchone()[0]
+        if next_attempt is None:
+            return self.max_retry_delay
+        return max(next_attempt - now, 0.01)
+
+    def sent(self, message_ids):
+        '''Messages were written to the stream, later messages to the same
+        recipient can be claimed while these wait for the ack'''
+        with self._lock:
+            # Lost and put back meanwhile, or already acked and gone
+            self._conn.executemany("UPDATE messages SET claimed = ? WHERE id = ? AND claimed = ?",
+                                   [(SENT, message_id, CLAIMED) for message_id in message_ids])
+            self._changed.notify_all()
+
+    def done(self, message_ids):
+        '''Messages were delivered, forget them'''
+        with self._lock:
+            self._conn.executemany("DELETE FROM messages WHERE id = ?",
+                                   [(message_id,) for message_id in message_ids])
+            self._changed.notify_all()
+
+    def wait_done(self, message_ids, timeout):
+        '''Wait up to timeout seconds for the messages to be delivered.
+        Returns set of ids still not delivered'''
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                pending = set()
+                # Stay well below SQLite limit of 999 parameters
+                for start in range(0, len(message_ids), 500):
+                    chunk = message_ids[start:start + 500]
+                    pending.update(row[0] for row in self._conn.execute(
+                        "SELECT id FROM messages WHERE id IN (%s)" % ",".join("?" * len(chunk)),
+                        chunk))
+                now = time.time()
+                if not pending or now >= deadline:
+                    return pending
+                self._changed.wait(deadline - now)
+
+    def retry(self, message_ids, attempts):
+        '''Delivery failed, put the messages back with exponential backoff'''
+        delay = min(self.retry_delay * 2 ** attempts, self.max_retry_delay)
+        # Jitter, so a recovered server isn't hit by all retries at once
+        delay = random.uniform(delay / 2.0, delay)
+        next_attempt = time.time() + delay
+        with self._lock:
+            self._conn.executemany("UPDATE messages SET claimed = ?, attempts = ?, "
+                                   "next_attempt = ? WHERE id = ?",
+                                   [(PENDING, attempts + 1, next_attempt, message_id)
+                                    for message_id in message_ids])
+            # notify_all, the ones waiting for delivery share the condition
+            self._changed.notify_all()
+        return delay
+
+    def stats(self, priority=None):
+        '''Returns queue depth and age of the oldest message in seconds,
+        of all messages or only of the given priority'''
+        with self._lock:
+            if priority is None:
+                depth, oldest = self._conn.execute("SELECT COUNT(*), MIN(created) "
+                                                   "FROM messages").fetchone()
+            else:
+                depth, oldest = self._conn.execute("SELECT COUNT(*), MIN(created) FROM messages "
+                                                   "WHERE priority = ?", (priority,)).fetchone()
+        if oldest is None:
+            return depth, 0
+        return depth, time.time() - oldest
@@ -1,6 +1,6 @@
 #Port for the daemon to listen
 port = 8100
-# Bot JID for the daemon to connect with
+# Bot JID for the daemon to connect with, or list of them to send through several accounts
 jid = "botuser@somedomein.com/bot"
 # Where to send to in case "to" is missing in request
 to = "user2@somedomein.com"
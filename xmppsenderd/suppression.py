@@ -0,0 +1,94 @@
+# Alert storm suppression for xmppsenderd.
+# Duplicate messages and messages over the per-recipient rate are dropped
+# before they are queued, and reported later as a single summary message.
+
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class Suppressor(object):
+    """
+    Per-recipient token bucket rate limiter with TTL dedup cache.
+
+    The first message with some text to a recipient passes, the same
+    message within dedup_ttl seconds is only counted. Messages with
+    priority above 0 are never rate limited, only their repeats are
+    dropped. Both caches are bounded by max_entries, the oldest entries
+    are evicted first.
+    """
+
+    def __init__(self, rate=1.0, burst=20, dedup_ttl=60, max_entries=10000):
+        self.rate = rate
+        self.burst = burst
+        self.dedup_ttl = dedup_ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # recipient -> [tokens, last update time], least recently used first
+        self._buckets = OrderedDict()
+        # (recipient, message hash) -> [expiry time, recipient, message, repeats, kind],
+        # the oldest first, so expired entries are always in front
+        self._seen = OrderedDict()
+        # (recipient, kind) -> number of messages dropped by rate limit
+        self._limited = {}
+        # summaries of evicted entries waiting for the next sweep
+        self._summaries = []
+
+    def admit(self, recipient, message, kind='chat', priority=0):
+        '''Returns True if message should be sent, False if it is suppressed.
+        kind is the XMPP message type, the summary is sent with it'''
+        now = time.time()
+        key = (recipient, hashlib.sha1(message.encode('utf-8')).hexdigest())
+        with self._lock:
+            if self.dedup_ttl:
+                entry = self._seen.get(key)
+                if entry and entry[0] > now:
+                    entry[3] += 1
+                    return False
+            if self.rate and priority <= 0 and not self._take_token(recipient, now):
+                self._limited[recipient, kind] = self._limited.get((recipient, kind), 0) + 1
+                return False
+            if self.dedup_ttl:
+                self._remember(key, recipient, message, kind, now)
+        return True
+
+    def _take_token(self, recipient, now):
+        tokens, updated = self._buckets.pop(recipient, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if len(self._buckets) >= self.max_entries:
+            self._buckets.popitem(last=False)
+        if tokens < 1:
+            self._buckets[recipient] = (tokens, now)
+            return False
+        self._buckets[recipient] = (tokens - 1, now)
+        return True
+
+    def _remember(self, key, recipient, message, kind, now):
+        # Expired entry for the key is replaced, keeping its summary
+        self._evict(self._seen.pop(key, None))
+        while len(self._seen) >= self.max_entries:
+            self._evict(self._seen.popitem(last=False)[1])
+        self._seen[key] = [now + self.dedup_ttl, recipient, message, 0, kind]
+
+    def _evict(self, entry):
+        if entry and entry[3]:
+            self._summaries.append((entry[1], entry[4], u"[%s repeats] %s" % (entry[3], entry[2])))
+
+    def sweep(self):
+        '''Expire dedup entries and return list of (recipient, kind, summary)
+        for everything suppressed since the last sweep'''
+        now = time.time()
+        with self._lock:
+            while self._seen:
+                key, entry = next(self._seen.iteritems())
+                if entry[0] > now:
+                    break
+                del self._seen[key]
+                self._evict(entry)
+            summaries = self._summaries
+            self._summaries = []
+            for (recipient, kind), dropped in self._limited.iteritems():
+                summaries.append((recipient, kind, u"[%s messages dropped by rate limit]" % dropped))
+            self._limited = {}
+        return summaries
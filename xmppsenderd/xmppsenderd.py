@@ -6,43 +6,258 @@
 # Use settings.py to define defaults
 # Use it with: curl "http://localhost:8100/send?msg=tratatatata%20lalalala"
 # or: curl "http://localhost:8100/send?to=username@domain.com&msg=tratatatata%20lalalala"
+# Messages are queued on disk and sent in background, "202 Accepted" is returned at once.
+# Several recipients and multi-user chat rooms, with JSON status of each of them:
+# curl "http://localhost:8100/send?to=one@domain.com,two@domain.com&room=oncall@conference.domain.com&msg=down"
+# Add wait=5 to wait up to 5 seconds for the server to confirm delivery, "200 OK" if all were.
+# Urgent messages skip the queued bulk: curl "http://localhost:8100/send?priority=high&msg=down"
+# Queue depth and age of the oldest message: curl "http://localhost:8100/queue"
+# Batch of messages as JSON array or one JSON object per line:
+# curl --data-binary '[{"to": "username@domain.com", "msg": "one"}, {"msg": "two"}]' "http://localhost:8100/batch"
+# Prometheus metrics: curl "http://localhost:8100/metrics"
 
 import os
 import sys
+import time
+import threading
 import sleekxmpp
+from sleekxmpp.exceptions import IqError, IqTimeout
+from sleekxmpp.plugins.xep_0198 import stanza as sm_stanza
+from sleekxmpp.xmlstream.handler import Callback
+from sleekxmpp.xmlstream.matcher import MatchXPath, MatchMany
 import logging
 import urlparse
 import getpass
+import Queue
+import json
+import functools
+import socket
+import select
+import bisect
+import hashlib
 from optparse import OptionParser
-from httplib import OK, NOT_FOUND, FORBIDDEN, CONFLICT, INTERNAL_SERVER_ERROR
+from httplib import OK, ACCEPTED, BAD_REQUEST, NOT_FOUND, FORBIDDEN, CONFLICT, INTERNAL_SERVER_ERROR
+from httplib import LENGTH_REQUIRED, REQUEST_ENTITY_TOO_LARGE
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from sendqueue import SendQueue
+from suppression import Suppressor
+import metrics
 
 # Setup logging. Raise to debug to find out errors
 #loglevel = logging.DEBUG
 loglevel = logging.INFO
 logging.basicConfig(level=loglevel, format='%(levelname)-8s %(message)s')
 
+# Largest body accepted by /batch, in bytes
+MAX_BATCH_SIZE = 10 * 1024 * 1024
+# Longest /send is allowed to wait for delivery, in seconds
+MAX_SEND_WAIT = 60
+
+HTTP_REQUESTS = metrics.Counter("xmppsenderd_http_requests_total",
+                                "HTTP requests by response status code", ["code"])
+CONNECT_SECONDS = metrics.Histogram("xmppsenderd_connect_seconds",
+                                    "Time to open connection to the XMPP server")
+AUTH_SECONDS = metrics.Histogram("xmppsenderd_auth_seconds",
+                                 "Time from connection to started session, TLS, SASL and bind")
+SESSION_SETUP_SECONDS = metrics.Histogram("xmppsenderd_session_setup_seconds",
+                                          "Time to send presence and get roster on session start")
+DELIVERY_SECONDS = metrics.Histogram("xmppsenderd_delivery_seconds",
+                                     "Time to hand queued messages to XMPP session")
+DELIVERY_FAILURES = metrics.Counter("xmppsenderd_delivery_failures_total",
+                                    "Deliveries put back to the queue to be retried")
+RECONNECTS = metrics.Counter("xmppsenderd_reconnects_total",
+                             "Reconnects of XMPP sessions")
+SUPPRESSED = metrics.Counter("xmppsenderd_suppressed_total",
+                             "Messages dropped as duplicates or over the rate limit")
+QUEUE_DEPTH = metrics.Gauge("xmppsenderd_queue_depth",
+                            "Messages waiting in the send queue")
+QUEUE_OLDEST_AGE = metrics.Gauge("xmppsenderd_queue_oldest_age_seconds",
+                                 "Age of the oldest message in the send queue")
+HIGH_QUEUE_DEPTH = metrics.Gauge("xmppsenderd_high_priority_queue_depth",
+                                 "High priority messages waiting in the send queue")
+HIGH_QUEUE_OLDEST_AGE = metrics.Gauge("xmppsenderd_high_priority_queue_oldest_age_seconds",
+                                      "Age of the oldest high priority message in the send queue")
+LOST_MESSAGES = metrics.Counter("xmppsenderd_lost_messages_total",
+                                "Messages not acked before the stream was lost, sent again")
+UNACKED_MESSAGES = metrics.Gauge("xmppsenderd_unacked_messages",
+                                 "Messages sent but not acked by the server yet")
+READY_SESSIONS = metrics.Gauge("xmppsenderd_ready_sessions",
+                               "XMPP sessions ready to send")
+
+
+# What a session does when it starts:
+#   full   - broadcasts presence and fetches the roster on every session start
+#   cached - broadcasts presence, fetches the roster only once and again
+#            after a roster push, keeping it across reconnects
+#   lean   - send-only, no presence and no roster at all
+SESSION_MODES = ('full', 'cached', 'lean')
+
+# Message priorities as stored in the queue. High priority messages
+# are sent before all normal ones and have delivery workers of their own.
+PRIORITIES = {'normal': 0, 'high': 1}
+HIGH_PRIORITY = PRIORITIES['high']
+
 
 class SendMsgBot(sleekxmpp.ClientXMPP):
     """
-    A basic SleekXMPP bot that will log in, send a message,
-    and then log out.
+    A basic SleekXMPP bot that will log in once and keep
+    the session open to send messages handed to it.
     """
 
-    def __init__(self, jid, password, recipient, message):
+    def __init__(self, jid, password, mode='lean'):
         sleekxmpp.ClientXMPP.__init__(self, jid, password)
+        self.mode = mode
+        # Set once the roster is fetched, cleared by roster pushes
+        self.roster_fetched = False
+        # Messages sent over stream management, but not acked by
+        # the server yet: stanza id -> (acked, lost) callbacks
+        self.unacked = {}
+        self.unacked_lock = threading.Lock()
+        # Multi-user chat rooms joined on the current session
+        self.rooms = set()
 
-        # The message we wish to send, and the JID that
-        # will receive it.
-        self.recipient = recipient
-        self.msg = message
+        # Set once the session is established and cleared
+        # when the stream goes down, so the pool knows
+        # whether this bot can take messages.
+        self.ready = threading.Event()
+        # When the current stream was connected, to time the login
+        self.connected_at = None
+        # Seconds to wait for the server to answer stream resumption
+        self.resume_timeout = 10
+        # Reconnect delay of a resumable stream, SleekXMPP waits
+        # twice that and doubles it on every failed attempt
+        self.resume_reconnect_delay = 0.05
 
         # The session_start event will be triggered when
         # the bot establishes its connection with the server
         # and the XML streams are ready for use. We want to
         # listen for this event so that we we can initialize
         # our roster.
+        self.add_event_handler("connected", self.connected)
         self.add_event_handler("session_start", self.start)
+        self.add_event_handler("session_resumed", self.resumed)
+        self.add_event_handler("disconnected", self.disconnected)
+        self.add_event_handler("roster_update", self.roster_pushed)
+        # XEP-0198 events, see send_tracked()
+        self.add_event_handler("stanza_acked", self.acked)
+        self.add_event_handler("sm_failed", self.unacked_lost)
+        self.add_event_handler("session_end", self.unacked_lost)
+
+    def use_stream_management(self, window=5):
+        """
+        Register XEP-0198 stream management.
+
+        A dropped stream is then resumed with one round trip instead
+        of full login, and stanzas not acked by the server are sent
+        again by SleekXMPP once the stream is resumed.
+        """
+        self.register_plugin('xep_0198', {'window': window,
+                                          'allow_resume': True})
+        # The plugin registers the feature for both of its orders,
+        # only its handler is replaced
+        self._stream_feature_handlers['sm'] = (self.negotiate_stream_management, True)
+
+    def negotiate_stream_management(self, features):
+        """
+        Resume the stream, or enable stream management, as the xep_0198
+        plugin does.
+
+        The plugin starts waiting for the reply to <resume/> only after
+        sending it, so a quick reply was missed and the session stalled
+        for response_timeout. Here the reply is caught by the reading
+        thread, and the wait ends as soon as the connection is lost.
+
+        Stream management enabled anew also starts counting anew. The
+        plugin kept the stanzas and the ack count of the old stream, so
+        the first ack popped more stanzas than it had and broke the
+        stream again, and the old stanzas were never acked nor lost.
+        """
+        plugin = self['xep_0198']
+        if 'stream_management' in self.features:
+            return False
+        # The stanza the old stream failed to send is written again once
+        # the session starts, though it is already sent again from the
+        # unacked queue on resume, or lost on a new stream. Sent twice it
+        # makes the server ack more stanzas than were queued.
+        self._XMLStream__failed_send_stanza = None
+        # The same goes for stanzas still queued for the old stream
+        self.drop_send_queue()
+        if not plugin.sm_id or not plugin.allow_resume:
+            if 'bind' in self.features:
+                with plugin.ack_lock:
+                    plugin.unacked_queue.clear()
+                    plugin.seq = 0
+                    plugin.last_ack = 0
+                # Sent again through the new stream
+                self.unacked_lost(None)
+            return plugin._handle_sm_feature(features)
+        replies = Queue.Queue()
+        self.register_handler(
+            Callback('resumed_or_failed',
+                     MatchMany([MatchXPath(sm_stanza.Resumed.tag_name()),
+                                MatchXPath(sm_stanza.Failed.tag_name())]),
+                     replies.put, once=True, instream=True))
+        connection = self.socket
+        plugin.enabled.set()
+        resume = sm_stanza.Resume(self)
+        resume['h'] = plugin.handled
+        resume['previd'] = plugin.sm_id
+        resume.send(now=True)
+        deadline = time.time() + self.resume_timeout
+        try:
+            while time.time() < deadline:
+                try:
+                    reply = replies.get(True, 0.1)
+                except Queue.Empty:
+                    if self.socket is not connection or self.stream_end_event.is_set():
+                        # Tried again on the next connection, the rest
+                        # of these features belong to the lost stream
+                        return True
+                    continue
+                if reply.name == 'resumed':
+                    return True
+                break
+            else:
+                logging.warning("Timed out resuming the stream of %s" % self.boundjid)
+        finally:
+            self.remove_handler('resumed_or_failed')
+        # Enabled anew after resource binding, not resumed once again
+        plugin.sm_id = None
+        return False
+
+    def drop_send_queue(self):
+        '''Forget what SleekXMPP has not written to the stream yet'''
+        while True:
+            try:
+                self.send_queue.get_nowait()
+            except Queue.Empty:
+                return
+            self.send_queue.task_done()
+
+    def reconnect(self, reattempt=True, wait=False, send_close=True):
+        """
+        Reconnect to the server, keeping XEP-0198 session resumable.
+
+        SleekXMPP closes the stream before reconnecting, which ends
+        the stream management session. With a stream management id
+        only the connection is dropped, so the stream can be resumed.
+        """
+        if 'xep_0198' in self.plugin and self['xep_0198'].sm_id:
+            send_close = False
+            # SleekXMPP resets the delay on every stream start, so
+            # its first reconnect would wait about 2 seconds. Resumption
+            # is cheap, unlike full login the delay protects servers from.
+            self.reconnect_delay = self.resume_reconnect_delay
+        return sleekxmpp.ClientXMPP.reconnect(self, reattempt, wait, send_close)
+
+    def connected(self, event):
+        """
+        Process the connected event, raised once TCP
+        connection to the server is open.
+        """
+        if self.connected_at is not None:
+            RECONNECTS.inc()
+        self.connected_at = time.time()
 
     def start(self, event):
         """
@@ -50,93 +265,768 @@ class SendMsgBot(sleekxmpp.ClientXMPP):
 
         Typical actions for the session_start event are
         requesting the roster and broadcasting an initial
-        presence stanza.
+        presence stanza. Sending messages doesn't need either,
+        so depending on the mode they are skipped or the
+        roster is fetched once.
 
         Arguments:
             event -- An empty dictionary. The session_start
                      event does not provide any additional
                      data.
         """
-        self.send_presence()
-        self.get_roster()
+        # A new stream, the old one wasn't resumed,
+        # so whatever was not acked on it is lost
+        # and the rooms have to be joined again.
+        self.unacked_lost(event)
+        self.rooms = set()
+        started = time.time()
+        AUTH_SECONDS.observe(started - self.connected_at)
+        if self.mode != 'lean':
+            self.send_presence()
+            if self.mode == 'full' or not self.roster_fetched:
+                self.get_roster()
+                self.roster_fetched = True
+        SESSION_SETUP_SECONDS.observe(time.time() - started)
+        self.ready.set()
+        logging.info("Session for %s is ready" % self.boundjid)
+
+    def resumed(self, event):
+        """
+        Process the session_resumed event.
+
+        The stream was resumed with XEP-0198, no need to set
+        up the session again.
+        """
+        # Handled after the disconnected event if the stream was lost
+        # right away, messages sent then would go out twice on resume
+        if not self.session_started_event.is_set():
+            return
+        self.ready.set()
+        logging.info("Session for %s is resumed" % self.boundjid)
+
+    def disconnected(self, event):
+        """
+        Process the disconnected event.
+
+        SleekXMPP will reconnect on its own, we only stop
+        handing messages to this bot until it is back.
+        """
+        self.ready.clear()
+        logging.warning("Session for %s is disconnected" % self.boundjid)
+
+    def roster_pushed(self, iq):
+        """
+        Process the roster_update event.
+
+        A push from the server means our copy may be stale,
+        fetch the whole roster again on next session start.
+        """
+        if iq['type'] == 'set':
+            self.roster_fetched = False
+
+    def join_room(self, room):
+        """
+        Join the multi-user chat room, unless already in it.
+
+        Rooms only take messages from their occupants. The join is not
+        waited for, the server handles it before the messages sent
+        after it on the same stream.
+        """
+        if room in self.rooms:
+            return
+        # Registered on first use, most daemons never send to rooms
+        if 'xep_0045' not in self.plugin:
+            self.register_plugin('xep_0045')  # Multi-User Chat
+        # Unique resource of the session makes unique nick in the room
+        self['xep_0045'].joinMUC(room, self.boundjid.resource or self.boundjid.user,
+                                 maxhistory="0")
+        self.rooms.add(room)
+        logging.info("Session %s joined room %s" % (self.boundjid, room))
+
+    def send_tracked(self, recipient, message, acked=None, lost=None, mtype='chat'):
+        """
+        Send the message and call acked once the server confirms it.
+
+        With stream management the server acks the message and acked
+        is called then. If the stream is lost and can't be resumed,
+        lost is called instead so the message can be sent again.
+        Without stream management acked is called at once.
+        Messages of groupchat type go to a room, joined before the send.
+        """
+        if mtype == 'groupchat':
+            self.join_room(recipient)
+        stanza = self.make_message(mto=recipient, mbody=message, mtype=mtype)
+        tracked = ('xep_0198' in self.plugin and
+                   self['xep_0198'].enabled.is_set())
+        if tracked:
+            stanza['id'] = self.new_id()
+            with self.unacked_lock:
+                self.unacked[stanza['id']] = (acked, lost)
+        stanza.send()
+        if not tracked and acked:
+            acked()
+
+    def acked(self, stanza):
+        with self.unacked_lock:
+            callbacks = self.unacked.pop(stanza['id'], None)
+        if callbacks and callbacks[0]:
+            callbacks[0]()
+
+    def unacked_lost(self, event):
+        with self.unacked_lock:
+            lost = self.unacked.values()
+            self.unacked = {}
+        if lost:
+            logging.warning("%s messages sent by %s were not acked by the server"
+                            % (len(lost), self.boundjid))
+        for unused, callback in lost:
+            if callback:
+                callback()
+
+    def request_ack(self):
+        '''Ask the server to ack what is still waiting for it'''
+        if self.unacked and self['xep_0198'].enabled.is_set():
+            self['xep_0198'].request_ack()
+
+    def is_alive(self, timeout):
+        """
+        Ping the server to find out if the stream still works.
+
+        An error reply still means the server answered us,
+        only a timeout is treated as a dead session.
+        """
+        # Registered on first use, sessions without
+        # health checks never need it.
+        if 'xep_0199' not in self.plugin:
+            self.register_plugin('xep_0199')  # XMPP Ping
+        try:
+            self['xep_0199'].ping(timeout=timeout)
+        except IqError:
+            pass
+        except IqTimeout:
+            return False
+        return True
+
+
+class SessionPoolError(Exception):
+    pass
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys to nodes.
+
+    Every node is put on the ring many times, so keys spread evenly
+    and adding or losing a node moves only the keys it owned.
+    """
+
+    def __init__(self, nodes, key=str, replicas=100):
+        self._ring = []
+        for node in nodes:
+            for replica in range(replicas):
+                self._ring.append((self._hash("%s#%s" % (key(node), replica)), node))
+        self._ring.sort(key=lambda point: point[0])
+        self._points = [point[0] for point in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+    def walk(self, key):
+        '''Yields distinct nodes starting from the owner of the key'''
+        start = bisect.bisect(self._points, self._hash(key))
+        seen = set()
+        for index in range(len(self._ring)):
+            node = self._ring[(start + index) % len(self._ring)][1]
+            if id(node) not in seen:
+                seen.add(id(node))
+                yield node
+
+
+class SessionPool(object):
+    """
+    Pool of long-lived, pre-authenticated XMPP sessions.
+
+    Sessions are connected once at daemon start, the request
+    handlers only write message stanzas to them. A background
+    thread pings every session with XEP-0199, which also keeps idle
+    connections open, and reconnects the dead ones.
+
+    Servers throttle per account, so the pool can log in with several
+    accounts, each with size resources. Recipients are assigned to
+    sessions by consistent hashing, so messages to one recipient go
+    through the same session and keep their order.
+    """
+
+    def __init__(self, accounts, size=2, health_interval=30,
+                 ping_timeout=10, address=None, use_tls=True, mode='lean',
+                 stream_management=True, sm_window=5, instance=None):
+        # List of (jid, password)
+        self.accounts = accounts
+        # Part of the resource, so daemons sharing accounts don't
+        # take over each other's sessions
+        self.instance = instance
+        # (host, port) of the server if it can't be found from the JID
+        self.address = address
+        self.use_tls = use_tls
+        self.mode = mode
+        self.stream_management = stream_management
+        self.sm_window = sm_window
+        self.size = size
+        self.health_interval = health_interval
+        self.ping_timeout = ping_timeout
+        self.sessions = []
+        self.ring = None
+        self._stopping = threading.Event()
+
+    def _make_session(self, jid, password, number):
+        # Every pooled session needs its own resource,
+        # otherwise the server will kick the previous one.
+        session_jid = sleekxmpp.JID(jid)
+        resource = session_jid.resource or "xmppsenderd"
+        if self.instance:
+            resource = "%s-%s" % (resource, self.instance)
+        session_jid.resource = "%s-%s" % (resource, number)
+        session = SendMsgBot(session_jid.full, password, self.mode)
+        # Note that while plugins may have interdependencies,
+        # the order in which you register them does not matter.
+        # Sending needs no plugins, so only full sessions get them upfront.
+        if self.mode == 'full':
+            session.register_plugin('xep_0030')  # Service Discovery
+            session.register_plugin('xep_0199')  # XMPP Ping
+        if self.stream_management:
+            session.use_stream_management(self.sm_window)
+        if not self.use_tls:
+            # Only for test servers, password goes in clear text
+            session['feature_mechanisms'].unencrypted_plain = True
+
+        # If you are working with an OpenFire server, you may need
+        # to adjust the SSL version used:
+        # session.ssl_version = ssl.PROTOCOL_SSLv3
+
+        # If you want to verify the SSL certificates offered by a server:
+        # session.ca_certs = "path/to/ca/cert"
+        return session
+
+    def _connect(self, session):
+        # If you do not have the dnspython library installed,
+        # you will need to manually specify the name of the server
+        # if it does not match the one in the JID.
+        # For example, to use Google Talk you would need to use:
+        #
+        # if session.connect(('talk.google.com', 5222)):
+        #     ...
+        # connect() keeps reattempting until the server is reachable,
+        # process() will then reconnect by itself on stream loss.
+        started = time.time()
+        if session.connect(self.address or tuple(), use_tls=self.use_tls):
+            CONNECT_SECONDS.observe(time.time() - started)
+            session.process(block=False)
+        else:
+            logging.error("Unable to connect session %s" % session.boundjid)
+
+    def start(self):
+        for jid, password in self.accounts:
+            for number in range(self.size):
+                self.sessions.append(self._make_session(jid, password, number))
+        self.ring = HashRing(self.sessions, key=lambda session: session.boundjid.full)
+        for session in self.sessions:
+            connector = threading.Thread(target=self._connect, args=(session,),
+                                         name="connect-%s" % session.boundjid)
+            connector.daemon = True
+            connector.start()
+        health = threading.Thread(target=self._health_check, name="health-check")
+        health.daemon = True
+        health.start()
+
+    def stop(self):
+        self._stopping.set()
+        for session in self.sessions:
+            session.disconnect(wait=True)
+
+    def _health_check(self):
+        while not self._stopping.wait(self.health_interval):
+            for session in self.sessions:
+                if not session.ready.is_set():
+                    # Either still connecting or SleekXMPP is already
+                    # reconnecting, nothing to check yet.
+                    continue
+                if not session.is_alive(self.ping_timeout):
+                    logging.warning("Session %s failed health check, "
+                                    "reconnecting" % session.boundjid)
+                    session.ready.clear()
+                    session.reconnect()
+                elif self.stream_management:
+                    session.request_ack()
+
+    def request_acks(self):
+        '''Ask the server to ack unacked messages on all ready sessions'''
+        if self.stream_management:
+            for session in self.sessions:
+                if session.ready.is_set():
+                    session.request_ack()
+
+    def unacked_count(self):
+        return sum([len(session.unacked) for session in self.sessions])
+
+    def ready_count(self):
+        return len([session for session in self.sessions if session.ready.is_set()])
+
+    def _ready_session(self, recipient):
+        # The owner of the recipient, or the next ready one on the ring
+        for session in self.ring.walk(sleekxmpp.JID(recipient).bare):
+            if session.ready.is_set():
+                return session
+        return None
+
+    def send_message(self, recipient, message, timeout=10, acked=None, lost=None,
+                     mtype='chat'):
+        """
+        Write the message to one of the ready sessions.
+
+        Waits up to timeout seconds for a session to come up,
+        raises SessionPoolError if none did. See SendMsgBot.send_tracked
+        for acked and lost callbacks and mtype.
+        """
+        deadline = time.time() + timeout
+        session = self._ready_session(recipient)
+        while session is None:
+            if time.time() >= deadline:
+                raise SessionPoolError("No XMPP session is ready to send")
+            time.sleep(0.1)
+            session = self._ready_session(recipient)
+        session.send_tracked(recipient, message, acked, lost, mtype)
+        logging.debug("Sent message to %s via %s" % (recipient, session.boundjid))
+
 
-        self.send_message(mto=self.recipient,
-                          mbody=self.msg,
-                          mtype='chat')
+def split_jids(values):
+    """
+    JIDs from repeated and comma separated request parameters.
+
+    Returns list of unique JIDs in the order given.
+    """
+    jids = []
+    for value in values:
+        for jid in value.decode('utf-8', 'replace').split(","):
+            jid = jid.strip()
+            if jid and jid not in jids:
+                jids.append(jid)
+    return jids
+
+
+def parse_priority(name):
+    '''Returns queue priority of the named one, raises ValueError if unknown'''
+    try:
+        return PRIORITIES[name or 'normal']
+    except KeyError:
+        raise ValueError("priority must be one of %s" % ", ".join(sorted(PRIORITIES)))
 
-        # Using wait=True ensures that the send queue will be
-        # emptied before ending the session.
-        self.disconnect(wait=True)
 
+def parse_batch(data, default_to):
+    """
+    Parse batch of messages sent to /batch.
 
-class DaemonRequestHandler(BaseHTTPRequestHandler):
+    Accepts JSON array or newline delimited JSON of objects with "msg"
+    and optional "to" and "priority" keys.
+    Returns list of (recipient, message, priority).
+    """
+    data = data.strip()
+    if data.startswith("["):
+        items = json.loads(data)
+    else:
+        items = [json.loads(line) for line in data.splitlines() if line.strip()]
+    messages = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("msg"), basestring):
+            raise ValueError("every message must be an object with msg string")
+        for key in ("to", "priority"):
+            if item.get(key) is not None and not isinstance(item[key], basestring):
+                raise ValueError("%s must be a string" % key)
+        recipient = item.get("to") or default_to.decode('utf-8', 'replace')
+        messages.append((recipient, item["msg"], parse_priority(item.get("priority"))))
+    return messages
+
+
+class DeliveryWorker(threading.Thread):
+    """
+    Thread draining the send queue into the XMPP sessions.
+
+    Failed messages are put back to the queue to be retried
+    with exponential backoff. Messages are removed from the queue
+    only once the server acked them, if it supports stream management.
+    """
+
+    def __init__(self, send_queue, session_pool, number, min_priority=None):
+        if min_priority is None:
+            name = "delivery-%s" % number
+        else:
+            name = "delivery-priority-%s-%s" % (min_priority, number)
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.send_queue = send_queue
+        self.session_pool = session_pool
+        # Take only messages of this priority and above
+        self.min_priority = min_priority
+
+    def run(self):
+        while True:
+            message_ids, recipient, body, attempts, kind = self.send_queue.claim(
+                min_priority=self.min_priority)
+            started = time.time()
+            try:
+                self.session_pool.send_message(recipient, body,
+                                               acked=functools.partial(self.acked, message_ids),
+                                               lost=functools.partial(self.lost, message_ids, attempts),
+                                               mtype=kind)
+            except Exception:
+                DELIVERY_FAILURES.inc()
+                delay = self.send_queue.retry(message_ids, attempts)
+                logging.exception("Failure sending messages %s to %s, retry in %.1f seconds"
+                                  % (message_ids, recipient, delay))
+            else:
+                # Later messages to the recipient go out after this one
+                self.send_queue.sent(message_ids)
+                DELIVERY_SECONDS.observe(time.time() - started)
+
+    def acked(self, message_ids):
+        self.send_queue.done(message_ids)
+        logging.info("Done sending messages %s" % message_ids)
+
+    def lost(self, message_ids, attempts):
+        LOST_MESSAGES.inc(len(message_ids))
+        self.send_queue.retry(message_ids, attempts)
+        logging.warning("Messages %s were lost with the stream, will be sent again" % message_ids)
+
+
+class SummaryWorker(threading.Thread):
+    """
+    Thread queueing summaries of suppressed messages.
+
+    Runs every interval seconds, so a flapping alert results
+    in at most one summary per interval.
+    """
+
+    def __init__(self, suppressor, send_queue, interval=30):
+        threading.Thread.__init__(self, name="summary")
+        self.daemon = True
+        self.suppressor = suppressor
+        self.send_queue = send_queue
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            summaries = self.suppressor.sweep()
+            # Summaries for rooms go out as groupchat, like the messages
+            for kind in set(kind for recipient, kind, summary in summaries):
+                self.send_queue.put_many([(recipient, summary) for recipient, message_kind, summary
+                                          in summaries if message_kind == kind], kind=kind)
+            if summaries:
+                logging.info("Queued %s summaries of suppressed messages" % len(summaries))
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler, object):
     """
     Request handler to do all the work.
 
     Parses the request to send the message or anything else
     """
 
+    # Keep connections open between requests, every response
+    # carries Content-Length so clients know where it ends.
+    protocol_version = "HTTP/1.1"
+    # Longest wait for the rest of a request once it started to arrive,
+    # idle keep-alive connections are closed by the server.
+    timeout = 15
+    # Response headers and body are written separately, without this
+    # Nagle and delayed ACK add ~40ms to every keep-alive request.
+    disable_nagle_algorithm = True
+
     def do_GET(self):
         # Parse body
         self.body = urlparse.urlparse(self.path)
         self.passedparams = urlparse.parse_qs(self.body.query)
 
         if self.body.path == "/send":
+            recipients = split_jids(self.passedparams.get("to", []))
+            rooms = split_jids(self.passedparams.get("room", []))
+            if not recipients and not rooms:
+                recipients = [to.decode('utf-8', 'replace')]
             try:
-                self.to = self.passedparams["to"][0]
-            except:
-                self.to = to
-            self.message = self.passedparams["msg"][0]
-            # Setup the EchoBot and register plugins.
-            # Note that while plugins may have interdependencies,
-            # the order in which you register them does not matter.
-            self.xmpp = SendMsgBot(jid, password, self.to, self.message)
-            self.xmpp.register_plugin('xep_0030')  # Service Discovery
-            self.xmpp.register_plugin('xep_0199')  # XMPP Ping
-
-            # If you are working with an OpenFire server, you may need
-            # to adjust the SSL version used:
-            # xmpp.ssl_version = ssl.PROTOCOL_SSLv3
-
-            # If you want to verify the SSL certificates offered by a server:
-            # xmpp.ca_certs = "path/to/ca/cert"
-
-            # Connect to the XMPP server and start processing XMPP stanzas.
-            if self.xmpp.connect():
-                # If you do not have the dnspython library installed,
-                # you will need to manually specify the name of the server
-                # if it does not match the one in the JID.
-                # For example, to use Google Talk you would need to use:
-                #
-                # if xmpp.connect(('talk.google.com', 5222)):
-                #     ...
-                self.xmpp.process(block=True)
-                logging.info("Done sending the message")
-                self.send_response(OK)
+                self.message = self.passedparams["msg"][0]
+            except KeyError:
+                self._send_response(BAD_REQUEST, "Missing msg parameter\n")
+                return
+            try:
+                wait = min(float(self.passedparams.get("wait", [0])[0]), MAX_SEND_WAIT)
+            except ValueError:
+                self._send_response(BAD_REQUEST, "Invalid wait parameter\n")
+                return
+            try:
+                priority = parse_priority(self.passedparams.get("priority", [None])[0])
+            except ValueError, exc:
+                self._send_response(BAD_REQUEST, "Invalid priority: %s\n" % exc)
+                return
+            message = self.message.decode('utf-8', 'replace')
+            if len(recipients) == 1 and not rooms and not wait:
+                self._send_one(recipients[0], message, priority)
             else:
-                print("Unable to connect.")
-                self.send_response(INTERNAL_SERVER_ERROR)
+                self._send_many(recipients, rooms, message, wait, priority)
+        elif self.body.path == "/queue":
+            depth, oldest_age = self.server.send_queue.stats()
+            high_depth, high_oldest_age = self.server.send_queue.stats(HIGH_PRIORITY)
+            self._send_response(OK, "depth %s\noldest_age %.3f\nhigh_depth %s\nhigh_oldest_age %.3f\n"
+                                % (depth, oldest_age, high_depth, high_oldest_age))
+        elif self.body.path == "/metrics":
+            self._send_response(OK, metrics.render(),
+                                content_type='text/plain; version=0.0.4')
         else:
-            self.send_response(NOT_FOUND)
+            self._send_response(NOT_FOUND, "Not found\n")
             return
 
-    def _send_response(self, response, message):
+    def _send_one(self, recipient, message, priority):
+        if not self.server.suppressor.admit(recipient, message, priority=priority):
+            logging.debug("Suppressed message to %s" % recipient)
+            SUPPRESSED.inc()
+            self._send_response(ACCEPTED, "Suppressed\n")
+            return
+        # Store the message and return at once,
+        # delivery workers will send it in background.
+        message_id = self.server.send_queue.put(recipient, message, priority=priority)
+        logging.info("Queued message %s to %s" % (message_id, recipient))
+        self._send_response(ACCEPTED, "Queued %s\n" % message_id)
+
+    def _send_many(self, recipients, rooms, message, wait, priority):
+        # Every recipient gets its own queued message, so delivery
+        # workers send them in parallel through the sessions owning them.
+        statuses = []
+        message_ids = []
+        for kind, targets in (('chat', recipients), ('groupchat', rooms)):
+            admitted = []
+            for target in targets:
+                if self.server.suppressor.admit(target, message, kind, priority):
+                    admitted.append(target)
+                else:
+                    SUPPRESSED.inc()
+                    statuses.append({"to": target, "type": kind, "status": "suppressed"})
+            if not admitted:
+                continue
+            ids = self.server.send_queue.put_many([(target, message) for target in admitted],
+                                                  kind=kind, priority=priority)
+            for target, message_id in zip(admitted, ids):
+                statuses.append({"to": target, "type": kind, "status": "queued", "id": message_id})
+            message_ids.extend(ids)
+        logging.info("Queued messages %s to %s" % (message_ids, ", ".join(recipients + rooms)))
+        response = ACCEPTED
+        if wait and message_ids:
+            deadline = time.time() + wait
+            pending = self.server.send_queue.wait_done(message_ids, min(0.1, wait))
+            while pending and time.time() < deadline:
+                # Acks normally come once per sm_window messages, don't wait for that
+                self.server.session_pool.request_acks()
+                pending = self.server.send_queue.wait_done(message_ids,
+                                                           max(min(0.5, deadline - time.time()), 0))
+            for status in statuses:
+                if "id" in status and status["id"] not in pending:
+                    status["status"] = "delivered"
+            if not pending:
+                response = OK
+        self._send_response(response, json.dumps(statuses) + "\n",
+                            content_type='application/json')
+
+    def do_POST(self):
+        self.body = urlparse.urlparse(self.path)
+
+        if self.body.path == "/batch":
+            try:
+                length = int(self.headers["Content-Length"])
+            except (TypeError, ValueError):
+                self._send_response(LENGTH_REQUIRED, "Content-Length is required\n")
+                return
+            if length > MAX_BATCH_SIZE:
+                self._send_response(REQUEST_ENTITY_TOO_LARGE, "Batch is too large\n")
+                # The body is left unread, don't reuse the connection
+                self.close_connection = 1
+                return
+            try:
+                messages = parse_batch(self.rfile.read(length), to)
+            except ValueError, exc:
+                self._send_response(BAD_REQUEST, "Invalid batch: %s\n" % exc)
+                return
+            message_ids = []
+            for priority in sorted(set(PRIORITIES.values()), reverse=True):
+                admitted = [(recipient, message) for recipient, message, message_priority in messages
+                            if message_priority == priority and
+                            self.server.suppressor.admit(recipient, message, priority=priority)]
+                if admitted:
+                    message_ids.extend(self.server.send_queue.put_many(admitted, coalesce=True,
+                                                                       priority=priority))
+            SUPPRESSED.inc(len(messages) - len(message_ids))
+            logging.info("Queued batch of %s messages, %s suppressed"
+                         % (len(message_ids), len(messages) - len(message_ids)))
+            self._send_response(ACCEPTED, "Queued %s\nSuppressed %s\n"
+                                % (len(message_ids), len(messages) - len(message_ids)))
+        else:
+            self._send_response(NOT_FOUND, "Not found\n")
+            return
+
+    def send_response(self, code, message=None):
+        HTTP_REQUESTS.inc(labels=(code,))
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def _send_response(self, response, message, content_type='text/plain'):
         self.send_response(response)
-        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(message)))
         self.end_headers()
         self.wfile.write(message)
 
 
-def daemon_run(port, server_class=HTTPServer,
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+    HTTP server handling requests with a fixed number of worker threads.
+
+    Open connections are watched by one poller thread, a worker takes
+    a connection only once a request arrives on it, handles that request
+    and hands the connection back. So idle keep-alive connections don't
+    hold workers, and any number of clients share them. Connections idle
+    for keepalive_timeout seconds are closed.
+
+    Ready connections are handed to the workers through a bounded queue.
+    Once it is full the poller waits for a free worker.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, workers=16, backlog=128,
+                 keepalive_timeout=15):
+        # Must be set before the socket starts listening
+        self.request_queue_size = backlog
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.keepalive_timeout = keepalive_timeout
+        self.requests = Queue.Queue(maxsize=workers)
+        # Connections waiting for the next request, fd -> (handler, idle since)
+        self._idle = {}
+        # Connections handed back by workers, registered by the poller
+        self._returned = []
+        self._returned_lock = threading.Lock()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._poll = select.poll()
+        self._poll.register(self._wakeup_read, select.POLLIN)
+        poller = threading.Thread(target=self._poller, name="http-poller")
+        poller.daemon = self.daemon_threads
+        poller.start()
+        for number in range(workers):
+            worker = threading.Thread(target=self._worker, name="http-worker-%s" % number)
+            worker.daemon = self.daemon_threads
+            worker.start()
+
+    def _poller(self):
+        swept = time.time()
+        while True:
+            events = self._poll.poll(1000)
+            now = time.time()
+            for fd, unused_event in events:
+                if fd == self._wakeup_read:
+                    os.read(fd, 4096)
+                    with self._returned_lock:
+                        returned, self._returned = self._returned, []
+                    for handler in returned:
+                        self._idle[handler.request.fileno()] = (handler, now)
+                        self._poll.register(handler.request, select.POLLIN | select.POLLPRI)
+                else:
+                    # Readable, or closed by the client, either way a worker handles it
+                    handler = self._idle.pop(fd)[0]
+                    self._poll.unregister(fd)
+                    self.requests.put(handler)
+            if now - swept >= 1:
+                swept = now
+                for fd, (handler, since) in self._idle.items():
+                    if now - since >= self.keepalive_timeout:
+                        del self._idle[fd]
+                        self._poll.unregister(fd)
+                        self._close(handler)
+
+    def _hand_back(self, handler):
+        with self._returned_lock:
+            self._returned.append(handler)
+        os.write(self._wakeup_write, "x")
+
+    def _close(self, handler):
+        try:
+            handler.finish()
+        except socket.error:
+            pass
+        self.shutdown_request(handler.request)
+
+    def _worker(self):
+        while True:
+            handler = self.requests.get()
+            try:
+                while True:
+                    handler.close_connection = 1
+                    handler.handle_one_request()
+                    # Pipelined requests already read into the buffer
+                    # won't make the socket readable again
+                    if handler.close_connection or not handler.rfile._rbuf.tell():
+                        break
+            except:
+                self.handle_error(handler.request, handler.client_address)
+                handler.close_connection = 1
+            if handler.close_connection:
+                self._close(handler)
+            else:
+                self._hand_back(handler)
+
+    def process_request(self, request, client_address):
+        # The handler is kept for the life of the connection, so data
+        # buffered in its rfile isn't lost between requests. It is made
+        # without calling __init__, which would handle all requests at once,
+        # so it must be a new-style class.
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request = request
+        handler.client_address = client_address
+        handler.server = self
+        handler.setup()
+        self._hand_back(handler)
+
+
+def daemon_run(port, session_pool, send_queue, suppressor, workers=16, backlog=128,
+               keepalive_timeout=15, delivery_workers=2, priority_workers=1, summary_interval=30,
+               server_class=ThreadPoolHTTPServer,
                handler_class=DaemonRequestHandler):
     server_address = ('', port)
-    httpd = server_class(server_address, handler_class)
+    handler_class.timeout = keepalive_timeout
+    httpd = server_class(server_address, handler_class,
+                         workers=workers, backlog=backlog,
+                         keepalive_timeout=keepalive_timeout)
+    # Handlers reach the XMPP sessions and the queue through the server
+    httpd.session_pool = session_pool
+    httpd.send_queue = send_queue
+    httpd.suppressor = suppressor
+    QUEUE_DEPTH.callback = lambda: send_queue.stats()[0]
+    QUEUE_OLDEST_AGE.callback = lambda: send_queue.stats()[1]
+    HIGH_QUEUE_DEPTH.callback = lambda: send_queue.stats(HIGH_PRIORITY)[0]
+    HIGH_QUEUE_OLDEST_AGE.callback = lambda: send_queue.stats(HIGH_PRIORITY)[1]
+    READY_SESSIONS.callback = session_pool.ready_count
+    UNACKED_MESSAGES.callback = session_pool.unacked_count
+    session_pool.start()
+    # Normal workers take high priority messages first as well,
+    # priority workers keep sending them however deep the bulk is.
+    for number in range(delivery_workers):
+        DeliveryWorker(send_queue, session_pool, number).start()
+    for number in range(priority_workers):
+        DeliveryWorker(send_queue, session_pool, number, min_priority=HIGH_PRIORITY).start()
+    SummaryWorker(suppressor, send_queue, summary_interval).start()
     try:
-        logging.info("Starting daemon on port %s, "
-                     "%s JID will be used to send messages" % (port, jid))
+        logging.info("Starting daemon on port %s with %s workers, "
+                     "%s JID will be used to send messages"
+                     % (port, workers, ", ".join([account[0] for account in session_pool.accounts])))
         httpd.serve_forever()
     except KeyboardInterrupt:
         httpd.server_close()
+        session_pool.stop()
         pass
 
 if __name__ == '__main__':
@@ -146,10 +1036,59 @@ if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option('-p', '--port', type="int", dest='port', default=8100,
                       help='Service will listen on a port [default %default]')
-    parser.add_option('-j', '--jid', dest='jid', default=None,
-                      help='The bot JID, e.g. username@domain.com/bot [default %default]')
+    parser.add_option('-j', '--jid', dest='jid', action="append", default=None,
+                      help='The bot JID, e.g. username@domain.com/bot, repeat to send '
+                           'through several accounts [default %default]')
     parser.add_option('-t', '--to', dest='to', default=None,
                       help='The recipient JID, e.g. username@domain.com [default %default]')
+    parser.add_option('--pool-size', type="int", dest='pool_size', default=2,
+                      help='Number of XMPP sessions kept open for every JID [default %default]')
+    parser.add_option('--health-interval', type="int", dest='health_interval', default=30,
+                      help='Seconds between health check pings of sessions [default %default]')
+    parser.add_option('-w', '--workers', type="int", dest='workers', default=16,
+                      help='Number of threads serving HTTP requests [default %default]')
+    parser.add_option('--backlog', type="int", dest='backlog', default=128,
+                      help='Listen backlog for not yet accepted connections [default %default]')
+    parser.add_option('--keepalive-timeout', type="int", dest='keepalive_timeout', default=15,
+                      help='Seconds to keep idle HTTP/1.1 connections open [default %default]')
+    parser.add_option('-q', '--queue-file', dest='queue_file',
+                      default='/var/tmp/xmppsenderd-queue.db',
+                      help='SQLite file to keep not yet sent messages in [default %default]')
+    parser.add_option('--delivery-workers', type="int", dest='delivery_workers', default=2,
+                      help='Number of threads sending queued messages [default %default]')
+    parser.add_option('--priority-workers', type="int", dest='priority_workers', default=1,
+                      help='Number of threads sending only high priority messages [default %default]')
+    parser.add_option('--coalesce-window', type="float", dest='coalesce_window', default=0,
+                      help='Seconds to hold /batch messages to merge ones to the same JID [default %default]')
+    parser.add_option('--rate', type="float", dest='rate', default=1.0,
+                      help='Messages per second allowed to one recipient, 0 to disable, '
+                           'high priority messages are not limited [default %default]')
+    parser.add_option('--burst', type="int", dest='burst', default=20,
+                      help='Messages to one recipient allowed at once over the rate [default %default]')
+    parser.add_option('--dedup-ttl', type="int", dest='dedup_ttl', default=60,
+                      help='Seconds to drop repeats of the same message, 0 to disable [default %default]')
+    parser.add_option('--dedup-size', type="int", dest='dedup_size', default=10000,
+                      help='Most recipients and messages to remember for suppression [default %default]')
+    parser.add_option('--summary-interval', type="int", dest='summary_interval', default=30,
+                      help='Seconds between summaries of suppressed messages [default %default]')
+    parser.add_option('--server', dest='server', default=None,
+                      help='XMPP server as host:port, by default found from the JID domain')
+    parser.add_option('--no-tls', action="store_false", dest='use_tls', default=True,
+                      help='Do not use TLS with XMPP server, for test servers only')
+    parser.add_option('--password-file', dest='password_file', default=None,
+                      help='Read the JID password from file instead of asking for it')
+    parser.add_option('--session-mode', type="choice", dest='session_mode', default='lean',
+                      choices=SESSION_MODES,
+                      help='full: presence and roster on every login, cached: presence and roster '
+                           'fetched once, lean: send-only, neither of them [default %default]')
+    parser.add_option('--no-stream-management', action="store_false",
+                      dest='stream_management', default=True,
+                      help='Do not use XEP-0198 stream management and resumption')
+    parser.add_option('--sm-window', type="int", dest='sm_window', default=5,
+                      help='Messages to send before asking the server for ack [default %default]')
+    parser.add_option('--instance', dest='instance', default=socket.gethostname(),
+                      help='Name of this daemon put in session resources, must differ '
+                           'between daemons sharing the accounts [default %default]')
     options, unused_args = parser.parse_args()
 
     # FIX THIS: ugly
@@ -159,9 +1098,11 @@ if __name__ == '__main__':
         pass
 
     if options.jid:
-        jid = options.jid
+        jids = options.jid
+    elif isinstance(settings.jid, list):
+        jids = settings.jid
     else:
-        jid = settings.jid
+        jids = [settings.jid]
 
     if options.port:
         port = options.port
@@ -174,7 +1115,49 @@ if __name__ == '__main__':
     else:
         to = settings.to
 
-    password = getpass.getpass("Please type in password for JID %s:" % jid)
-    
+    # One password per line for every JID in the order given,
+    # the last one is used for the rest
+    if options.password_file:
+        with open(options.password_file) as password_file:
+            passwords = [line.rstrip("\n") for line in password_file if line.strip()]
+        accounts = [(jid, passwords[min(number, len(passwords) - 1)])
+                    for number, jid in enumerate(jids)]
+    else:
+        passwords = {}
+        for jid in jids:
+            bare_jid = jid.split("/")[0]
+            if bare_jid not in passwords:
+                passwords[bare_jid] = getpass.getpass("Please type in password for JID %s:" % bare_jid)
+        accounts = [(jid, passwords[jid.split("/")[0]]) for jid in jids]
+
+    if options.server:
+        host, server_port = options.server.rsplit(":", 1)
+        address = (host, int(server_port))
+    else:
+        address = None
+
+    session_pool = SessionPool(accounts,
+                               size=options.pool_size,
+                               instance=options.instance,
+                               health_interval=options.health_interval,
+                               address=address,
+                               use_tls=options.use_tls,
+                               mode=options.session_mode,
+                               stream_management=options.stream_management,
+                               sm_window=options.sm_window)
+
+    send_queue = SendQueue(options.queue_file,
+                           coalesce_window=options.coalesce_window)
+    suppressor = Suppressor(rate=options.rate,
+                            burst=options.burst,
+                            dedup_ttl=options.dedup_ttl,
+                            max_entries=options.dedup_size)
+
     # Start daemon, terminate with CTRL-C or put into background
-    daemon_run(port)
+    daemon_run(port, session_pool, send_queue, suppressor,
+               summary_interval=options.summary_interval,
+               delivery_workers=options.delivery_workers,
+               priority_workers=options.priority_workers,
+               workers=options.workers,
+               backlog=options.backlog,
+               keepalive_timeout=options.keepalive_timeout)